@@ -19,7 +19,7 @@
 
  Author: Chris Marrison
 
- Date Last Updated: 20220324
+ Date Last Updated: 20261016
 
 Copyright 2022 Chris Marrison / Infoblox
 
@@ -49,21 +49,1250 @@ POSSIBILITY OF SUCH DAMAGE.
 
 ------------------------------------------------------------------------
 """
-__version__ = '0.1.4'
+__version__ = '0.4.1'
 __author__ = 'Chris Marrison'
 __author_email__ = 'chris@infoblox.com'
 
 import bloxone
+import requests
 import os
+import sys
+import concurrent.futures
+import threading
+import collections
+import itertools
+import bisect
 import shutil
+import gzip
+import lzma
 import logging
 import argparse
 import ipaddress
+import socket
+import http.server
+import urllib.parse
+import mmap
+import struct
+import array
+import csv
+import multiprocessing
 import json
+import hashlib
+import codecs
+import re
+import time
+import random
+import email.utils
+import tempfile
+import asyncio
+import functools
+import types
 import pkg_resources
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # ** Global Variables **
 log = logging.getLogger(__name__)
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), 
+                                 '.cache', 'b1td_country_ip')
+DEFAULT_CACHE_TTL = 86400
+CHUNK_SIZE = 65536
+EXPAND_BATCH_SIZE = 1000000
+WRITE_BATCH_SIZE = 10000
+ENRICH_CHUNK_LINES = 100000
+LOOKUP_BATCH_SIZE = 65536
+DEFAULT_SERVE_INTERVAL = 3600
+LIST_PAGE_SIZE = 1000
+MAX_LIST_ITEMS = 50000
+DEFAULT_RETRY_ATTEMPTS = 5
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_RETRY_MAX_BACKOFF = 60
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+CSV_HEADERS = [ 'cidr', 'country' ]
+COMPRESSION_EXTENSIONS = { '.gz': 'gz', '.xz': 'xz', '.zst': 'zst' }
+NIOS_HEADER = ( 'header-responsepolicycnamerecord,fqdn*,_new_fqdn,' +
+                'canonical_name,comment,disabled,parent_zone,ttl,view' )
+ALL_COUNTRIES_KEY = 'ALL'
+DB_MAGIC = b'B1TDCIP\0'
+DB_FORMAT_VERSION = 1
+# magic, format, reserved, countries, table bytes, IPv4 ranges, 
+# IPv6 ranges, reserved, created
+DB_HEADER = struct.Struct('<8sHHIIIIIQ')
+# Lookup index and options for enrich_chunk(), set per worker process
+enrich_state = {}
+RETRY_EXCEPTIONS = ( requests.exceptions.ConnectionError,
+                     requests.exceptions.Timeout )
+if aiohttp:
+    RETRY_EXCEPTIONS += ( aiohttp.ClientConnectionError, asyncio.TimeoutError )
+
+# ** Classes **
+
+class CountryCache:
+    '''
+    On disk cache of country_ip responses keyed by ISO code
+
+    Each entry is stored as <ISO>.json containing the raw response body
+    with a <ISO>.meta sidecar recording when it was retrieved and the
+    ETag/Last-Modified validators used to revalidate stale entries.
+    '''
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, 
+                       ttl=DEFAULT_CACHE_TTL,
+                       refresh=False,
+                       table_ttl=None):
+        '''
+        Parameters:
+            cache_dir (str): Directory for cache files
+            ttl (int): Seconds an entry is considered fresh
+            refresh (bool): Ignore fresh entries and retrieve again
+            table_ttl (int): Seconds the countries table is considered
+                             fresh, defaults to ttl
+        '''
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.table_ttl = ttl if table_ttl is None else table_ttl
+        self.refresh = refresh
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def _path(self, key, ext='json'):
+        return os.path.join(self.cache_dir, f'{key}.{ext}')
+
+
+    def _write(self, path, data):
+        # Write to temp file and rename so readers never see partial data
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+
+    def meta(self, key):
+        '''
+        Return metadata for entry or empty dict
+        '''
+        try:
+            with open(self._path(key, 'meta')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def is_fresh(self, key):
+        '''
+        Check whether entry exists and is within the TTL
+        '''
+        fetched = self.meta(key).get('fetched', 0)
+        ttl = self.table_ttl if key == 'countries' else self.ttl
+        return (not self.refresh and 
+                os.path.isfile(self._path(key)) and
+                (time.time() - fetched) < ttl)
+
+
+    def load(self, key):
+        '''
+        Return cached body for key, or None if missing or stale
+        '''
+        body = None
+        if self.is_fresh(key):
+            try:
+                with open(self._path(key), 'rb') as f:
+                    body = f.read()
+                log.debug(f'Cache hit for {key}')
+            except OSError:
+                body = None
+
+        return body
+
+
+    def validators(self, key):
+        '''
+        Return conditional request headers for a cached entry
+
+        Returns:
+            dict of If-None-Match/If-Modified-Since headers, empty if the
+            entry has no validators or refresh is set
+        '''
+        headers = {}
+        if not self.refresh and os.path.isfile(self._path(key)):
+            meta = self.meta(key)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        return headers
+
+
+    def revalidated(self, key):
+        '''
+        Mark entry as fresh following a 304 Not Modified
+
+        Returns:
+            cached body or None if it can no longer be read
+        '''
+        body = None
+        try:
+            with open(self._path(key), 'rb') as f:
+                body = f.read()
+            self.touch(key)
+        except OSError as err:
+            log.warning(f'Unable to revalidate cache entry {key}: {err}')
+
+        return body
+
+
+    def touch(self, key):
+        '''
+        Reset the age of an entry following a 304 Not Modified
+        '''
+        try:
+            meta = self.meta(key)
+            meta.update({ 'fetched': time.time() })
+            self._write(self._path(key, 'meta'), json.dumps(meta).encode())
+            log.debug(f'Cache entry {key} not modified')
+        except OSError as err:
+            log.warning(f'Unable to revalidate cache entry {key}: {err}')
+
+        return
+
+
+    def chunks(self, key, chunk_size=CHUNK_SIZE):
+        '''
+        Generator returning the cached body for key in chunks
+        '''
+        with open(self._path(key), 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                yield chunk
+
+
+    def store_stream(self, key, chunks, **meta):
+        '''
+        Generator passing chunks through whilst writing them to the cache.
+        The entry is only committed once chunks is exhausted, so an 
+        interrupted download never replaces a good entry.
+        '''
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        committed = False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp, self._path(key))
+            committed = True
+            meta.update({ 'fetched': time.time() })
+            self._write(self._path(key, 'meta'), json.dumps(meta).encode())
+        except OSError as err:
+            log.warning(f'Unable to write cache entry {key}: {err}')
+        finally:
+            if not committed and os.path.exists(tmp):
+                os.unlink(tmp)
+
+        return
+
+
+    def store(self, key, body, **meta):
+        '''
+        Store response body and metadata for key
+        '''
+        try:
+            self._write(self._path(key), body)
+            meta.update({ 'fetched': time.time() })
+            self._write(self._path(key, 'meta'), 
+                        json.dumps(meta).encode())
+        except OSError as err:
+            log.warning(f'Unable to write cache entry {key}: {err}')
+
+        return
+
+
+    def iso_code(self, b1td, country, retry=None):
+        '''
+        Resolve country name or ISO code to ISO code using a cached
+        copy of the TIDE country table
+
+        Parameters:
+            b1td (obj): bloxone.b1td instance
+            country (str): Country name or ISO code
+            retry (obj): Optional RetryPolicy for the API call
+
+        Returns:
+            iso_code (str) or None if not found
+        '''
+        if len(country) == 2:
+            return country.upper()
+
+        body = self.load('countries')
+        if body is None:
+            if retry is None:
+                retry = RetryPolicy(attempts=1)
+            response = retry.call(b1td.get_countries)
+            if response.status_code not in b1td.return_codes_ok:
+                log.error('Unable to retrieve country list')
+                return None
+            body = response.content
+            self.store('countries', body)
+
+        country_codes = json.loads(body).get('country', [])
+        record = next((c for c in country_codes 
+                       if c['name'].casefold() == country.casefold()), {})
+
+        return record.get('iso_code')
+
+
+class RowWriter:
+    '''
+    Buffered writer that collects formatted rows and writes them in 
+    batches with a single writelines() call, to a file handler or stdout
+    '''
+
+    def __init__(self, outfile=None, batch_size=WRITE_BATCH_SIZE,
+                       formatter=None):
+        '''
+        Parameters:
+            outfile (obj): filehandler, stdout if not set
+            batch_size (int): Number of rows per write
+            formatter (callable): Formats a record as a row when the
+                                  writer is called with a record
+        '''
+        self.outfile = outfile or sys.stdout
+        self.batch_size = batch_size
+        self.formatter = formatter
+        self.buffer = []
+
+
+    def __call__(self, record):
+        '''
+        Format and buffer a record
+        '''
+        self.buffer.append(self.formatter(record))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+        return
+
+
+    def write(self, row):
+        '''
+        Buffer a single row, row must include line ending
+        '''
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+        return
+
+
+    def writerows(self, rows):
+        '''
+        Write iterable of rows in batches, rows must include line endings
+        '''
+        self.flush()
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            self.outfile.writelines(batch)
+
+        return
+
+
+    def flush(self):
+        '''
+        Write any buffered rows
+        '''
+        if self.buffer:
+            self.outfile.writelines(self.buffer)
+            self.buffer = []
+
+        return
+
+
+class RateLimiter:
+    '''
+    Thread safe limiter spacing calls at least 1/rate seconds apart
+    '''
+
+    def __init__(self, rate=0):
+        '''
+        Parameters:
+            rate (float): Calls per second, 0 for no limit
+        '''
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        '''
+        Block until the next call is allowed
+        '''
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+        return
+
+
+class RetryPolicy:
+    '''
+    Shared retry policy for API calls. Calls returning 429 or 5xx, or
+    raising a connection error, are retried with exponential backoff
+    and full jitter, honouring any Retry-After header. Retries are
+    counted for the run summary.
+    '''
+
+    def __init__(self, attempts=DEFAULT_RETRY_ATTEMPTS,
+                       backoff=DEFAULT_RETRY_BACKOFF,
+                       max_backoff=DEFAULT_RETRY_MAX_BACKOFF,
+                       timeout=DEFAULT_READ_TIMEOUT):
+        '''
+        Parameters:
+            attempts (int): Maximum attempts per call, 1 for no retries
+            backoff (float): Base delay in seconds, doubled per attempt
+            max_backoff (float): Maximum delay in seconds between
+                                 attempts, including Retry-After
+            timeout (float): Seconds to wait for data on requests made
+                             directly, a stalled request then fails and
+                             is retried
+        '''
+        self.attempts = max(attempts, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.retries = collections.Counter()
+        self.exhausted = 0
+        self.lock = threading.Lock()
+
+
+    @staticmethod
+    def retryable(response):
+        '''
+        Return True if the response status is worth retrying
+        '''
+        status = getattr(response, 'status_code',
+                         getattr(response, 'status', None))
+        return status == 429 or (status is not None and 500 <= status < 600)
+
+
+    @staticmethod
+    def retry_after(response):
+        '''
+        Return seconds requested by a Retry-After header, or None
+        '''
+        headers = getattr(response, 'headers', None) or {}
+        value = headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(when.timestamp() - time.time(), 0)
+
+
+    def delay(self, attempt, response=None, reason=''):
+        '''
+        Record a retry and return the seconds to wait before it
+
+        Parameters:
+            attempt (int): Number of the attempt that failed, from 1
+            response (obj): Optional response that failed
+            reason (str): Status code or error counted in the summary
+        '''
+        with self.lock:
+            self.retries[str(reason)] += 1
+        wait = self.retry_after(response) if response is not None else None
+        if wait is None:
+            cap = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            wait = random.uniform(0, cap)
+
+        return min(wait, self.max_backoff)
+
+
+    def give_up(self):
+        '''
+        Record a call that failed on its last attempt
+        '''
+        with self.lock:
+            self.exhausted += 1
+
+        return
+
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Call func with retries, returning the last response
+
+        Raises:
+            The last connection error if every attempt raised one
+        '''
+        for attempt in range(1, self.attempts + 1):
+            last = attempt == self.attempts
+            try:
+                response = func(*args, **kwargs)
+            except RETRY_EXCEPTIONS as err:
+                if last:
+                    self.give_up()
+                    raise
+                wait = self.delay(attempt, reason=type(err).__name__)
+                log.warning(f'{err}, retrying in {wait:.1f}s')
+            else:
+                if not self.retryable(response):
+                    return response
+                if last:
+                    self.give_up()
+                    return response
+                wait = self.delay(attempt, response,
+                                  reason=response.status_code)
+                log.warning(f'HTTP {response.status_code}, ' +
+                            f'retrying in {wait:.1f}s')
+                # Release any streamed connection before trying again
+                response.close()
+            time.sleep(wait)
+
+
+    async def call_async(self, func, *args, **kwargs):
+        '''
+        Await func with retries, returning the last response. Responses
+        are expected to provide status as aiohttp does.
+        '''
+        for attempt in range(1, self.attempts + 1):
+            last = attempt == self.attempts
+            try:
+                response = await func(*args, **kwargs)
+            except RETRY_EXCEPTIONS as err:
+                if last:
+                    self.give_up()
+                    raise
+                wait = self.delay(attempt, reason=type(err).__name__)
+                log.warning(f'{err or type(err).__name__}, ' +
+                            f'retrying in {wait:.1f}s')
+            else:
+                if not self.retryable(response):
+                    return response
+                if last:
+                    self.give_up()
+                    return response
+                wait = self.delay(attempt, response, reason=response.status)
+                log.warning(f'HTTP {response.status}, ' +
+                            f'retrying in {wait:.1f}s')
+            await asyncio.sleep(wait)
+
+
+    def summary(self):
+        '''
+        Return description of retries made, empty if there were none
+        '''
+        with self.lock:
+            if not self.retries:
+                return ''
+            total = sum(self.retries.values())
+            reasons = ', '.join(f'{reason} x{count}' for reason, count
+                                in self.retries.most_common())
+            summary = f'Retried API calls {total} times ({reasons})'
+            if self.exhausted:
+                summary += f', {self.exhausted} failed after ' + \
+                           f'{self.attempts} attempts'
+
+        return summary
+
+
+class CustomListIndex:
+    '''
+    In memory index of custom list names and ids, retrieved with a 
+    single paged fetch so existence checks need no further API calls
+    '''
+
+    def __init__(self, b1tdc, page_size=LIST_PAGE_SIZE, retry=None):
+        '''
+        Parameters:
+            b1tdc (obj): bloxone.b1tdc object class
+            page_size (int): Number of lists retrieved per request
+            retry (obj): Optional RetryPolicy for the API calls
+        '''
+        self.lists = {}
+        self.lock = threading.Lock()
+        if retry is None:
+            retry = RetryPolicy(attempts=1)
+        offset = 0
+        while True:
+            response = retry.call(b1tdc.get_custom_lists, 
+                                  _fields='name,id', 
+                                  _limit=str(page_size),
+                                  _offset=str(offset))
+            if response.status_code not in b1tdc.return_codes_ok:
+                raise requests.exceptions.HTTPError(
+                    f'Unable to retrieve custom lists: ' +
+                    f'{response.status_code} - {response.text}',
+                    response=response)
+            page = response.json().get('results', [])
+            for custom_list in page:
+                self.lists[custom_list.get('name')] = custom_list.get('id')
+            if len(page) < page_size:
+                break
+            offset += page_size
+        log.debug(f'Indexed {len(self.lists)} custom lists')
+
+
+    def get(self, name):
+        '''
+        Return id of custom list or None if it does not exist
+        '''
+        with self.lock:
+            return self.lists.get(name)
+
+
+    def add(self, name, list_id):
+        '''
+        Record a newly created custom list
+        '''
+        with self.lock:
+            self.lists[name] = list_id
+
+        return
+
+
+    def names(self):
+        '''
+        Return names of all indexed custom lists
+        '''
+        with self.lock:
+            return list(self.lists)
+
+
+class UploadJournal:
+    '''
+    Local record of custom list uploads so an interrupted run can be
+    resumed. Each list is stored with a hash of its items and whether
+    the upload was confirmed, and the journal is rewritten atomically
+    after every upload.
+    '''
+
+    def __init__(self, filename, base_name='', resume=False):
+        '''
+        Parameters:
+            filename (str): Journal file
+            base_name (str): Base name of the custom lists
+            resume (bool): Load entries from a previous run, otherwise
+                           the journal starts empty
+        '''
+        self.filename = filename
+        self.base_name = base_name
+        self.lists = {}
+        self.lock = threading.Lock()
+        if resume:
+            try:
+                with open(filename, 'r') as f:
+                    journal = json.load(f)
+                if journal.get('base_name') == base_name:
+                    self.lists = journal.get('lists', {})
+                else:
+                    log.warning(f'Journal {filename} is for ' +
+                                f'{journal.get("base_name")}, ignoring')
+            except FileNotFoundError:
+                log.info(f'No journal {filename}, nothing to resume')
+            except (IOError, ValueError) as err:
+                log.warning(f'Unable to read journal {filename}: {err}')
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+
+
+    @staticmethod
+    def digest(item_list):
+        '''
+        Return hash of the items of a custom list
+        '''
+        data = json.dumps(item_list, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode()).hexdigest()
+
+
+    def confirmed(self, name, digest):
+        '''
+        Return True if name was uploaded with the same items
+        '''
+        with self.lock:
+            entry = self.lists.get(name, {})
+        return entry.get('hash') == digest and entry.get('status') == 'done'
+
+
+    def record(self, name, digest, items, status):
+        '''
+        Record the outcome of an upload and save the journal
+        '''
+        with self.lock:
+            self.lists[name] = { 'hash': digest,
+                                 'items': items,
+                                 'status': 'done' if status else 'failed',
+                                 'time': int(time.time()) }
+            self.save()
+
+        return
+
+
+    def save(self):
+        '''
+        Write the journal atomically, callers hold the lock
+        '''
+        journal = { 'base_name': self.base_name, 'lists': self.lists }
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(
+                                       os.path.abspath(self.filename)),
+                                   prefix='.journal.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(journal, f)
+            os.replace(tmp, self.filename)
+        except (IOError, OSError) as err:
+            log.warning(f'Unable to write journal {self.filename}: {err}')
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+        return
+
+
+class AtomicFile:
+    '''
+    Output file written to a temporary file in the same directory, 
+    fsynced and atomically renamed in to place on close(). Readers of 
+    filename only ever see a complete file. Previous generations can 
+    be kept as <filename>.1 (newest) to <filename>.N.
+    '''
+
+    def __init__(self, filename, compression=None, keep=0, binary=False):
+        '''
+        Parameters:
+            filename (str): Name of output file
+            compression (str): gz, xz, zst or None
+            keep (int): Number of previous generations to keep
+            binary (bool): Open for bytes rather than text
+
+        Raises:
+            IOError, ValueError if compression is unavailable
+        '''
+        self.filename = filename
+        self.keep = keep
+        self.closed = False
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, self.tmp = tempfile.mkstemp(dir=directory, 
+                            prefix=f'.{os.path.basename(filename)}.',
+                            suffix='.tmp')
+        os.close(fd)
+        try:
+            self.handler = open_output(self.tmp, compression, binary=binary)
+        except (IOError, ValueError):
+            os.unlink(self.tmp)
+            raise
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.close()
+        return False
+
+
+    def write(self, data):
+        return self.handler.write(data)
+
+
+    def writelines(self, lines):
+        return self.handler.writelines(lines)
+
+
+    def flush(self):
+        return self.handler.flush()
+
+
+    def rotate(self):
+        '''
+        Shift previous generations and keep the current file as .1
+        '''
+        for n in range(self.keep - 1, 0, -1):
+            older = f'{self.filename}.{n}'
+            if os.path.exists(older):
+                os.replace(older, f'{self.filename}.{n + 1}')
+        if os.path.exists(self.filename):
+            newest = f'{self.filename}.1'
+            if os.path.exists(newest):
+                os.unlink(newest)
+            try:
+                # Hard link so filename stays in place until replaced
+                os.link(self.filename, newest)
+            except OSError:
+                shutil.copy2(self.filename, newest)
+
+        return
+
+
+    def close(self):
+        '''
+        Commit the output, replacing filename atomically
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.handler.close()
+
+            # Flush file data to disk before it becomes visible
+            fd = os.open(self.tmp, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            # Match permissions of existing file, or a new file
+            if os.path.exists(self.filename):
+                mode = os.stat(self.filename).st_mode & 0o777
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(self.tmp, mode)
+
+            if self.keep:
+                self.rotate()
+            os.replace(self.tmp, self.filename)
+        except BaseException:
+            # Never leave the temporary file behind
+            self.closed = False
+            self.abort()
+            raise
+
+        # Flush the directory so the rename survives a crash
+        fd = os.open(os.path.dirname(self.tmp), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        log.info(f'Output written to {self.filename}')
+
+        return
+
+
+    def abort(self):
+        '''
+        Discard the output, leaving any existing file untouched
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.handler.close()
+        except (IOError, ValueError):
+            pass
+        if os.path.exists(self.tmp):
+            os.unlink(self.tmp)
+        log.warning(f'Output to {self.filename} discarded')
+
+        return
+
+
+class CountryLookup:
+    '''
+    Immutable longest prefix match index mapping IP addresses to
+    countries. Subnets are flattened in to disjoint integer ranges, with
+    the most specific subnet winning where subnets are nested, held as
+    sorted start and end arrays per IP version and searched with a
+    binary search. With numpy, batches of IPv4 addresses are searched
+    in a single vectorised operation.
+    '''
+
+    def __init__(self, subnets, engine='auto'):
+        '''
+        Parameters:
+            subnets (iterable): dict {cidr, country}
+            engine (str): auto, numpy or python. auto uses numpy if
+                          available
+        '''
+        if engine == 'numpy' and not numpy:
+            log.warning('numpy not available, using python engine')
+        self.use_numpy = bool(numpy) and engine in ('auto', 'numpy')
+
+        ranges = { 4: [], 6: [] }
+        for subnet in subnets:
+            version, start, end = cidr_to_range(subnet.get('cidr'))
+            ranges[version].append((start, end, subnet.get('country')))
+
+        self.countries = tuple(sorted({ r[2] for v in ranges.values()
+                                        for r in v }, key=str))
+        codes = { country: n for n, country in enumerate(self.countries) }
+        self.starts = {}
+        self.ends = {}
+        self.codes = {}
+        for version, version_ranges in ranges.items():
+            flat = flatten_ranges(version_ranges)
+            self.starts[version] = tuple(r[0] for r in flat)
+            self.ends[version] = tuple(r[1] for r in flat)
+            self.codes[version] = tuple(codes[r[2]] for r in flat)
+
+        if self.use_numpy:
+            # IPv4 fits in uint32, IPv6 batches use the python search
+            self.np_starts = numpy.array(self.starts[4], dtype=numpy.uint32)
+            self.np_ends = numpy.array(self.ends[4], dtype=numpy.uint32)
+            self.np_codes = numpy.array(self.codes[4], dtype=numpy.int32)
+            # Trailing None is returned for misses
+            self.np_countries = numpy.array(self.countries + (None,),
+                                            dtype=object)
+            for values in (self.np_starts, self.np_ends, self.np_codes,
+                           self.np_countries):
+                values.flags.writeable = False
+        log.debug(f'Lookup index of {len(self)} ranges for ' +
+                  f'{len(self.countries)} countries')
+
+
+    def __len__(self):
+        return len(self.starts[4]) + len(self.starts[6])
+
+
+    def ranges(self, version):
+        '''
+        Generator returning the disjoint ranges of an IP version
+
+        Yields:
+            tuple (start, end, country)
+        '''
+        for start, end, code in zip(self.starts[version], self.ends[version],
+                                    self.codes[version]):
+            yield start, end, self.countries[code]
+
+        return
+
+
+    def lookup_int(self, version, value):
+        '''
+        Return country for an integer address or None if not found
+        '''
+        n = bisect.bisect_right(self.starts[version], value) - 1
+        if n >= 0 and value <= self.ends[version][n]:
+            return self.countries[self.codes[version][n]]
+
+        return None
+
+
+    def lookup(self, address):
+        '''
+        Return country for an IPv4 or IPv6 address or None if not found
+
+        Raises:
+            ValueError if not a valid address
+        '''
+        return self.lookup_int(*ip_to_int(address))
+
+
+    def lookup_ints(self, version, values):
+        '''
+        Return list of countries for a sequence of integer addresses,
+        None where not found
+        '''
+        if self.use_numpy and version == 4:
+            return self.np_countries[self.lookup_codes(values)].tolist()
+
+        return [ self.lookup_int(version, value) for value in values ]
+
+
+    def lookup_codes(self, values):
+        '''
+        Vectorised search for IPv4 integer addresses, requires numpy
+
+        Returns:
+            numpy array of indexes in to np_countries, len(countries) 
+            where not found
+        '''
+        values = numpy.asarray(values, dtype=numpy.uint32)
+        n = numpy.searchsorted(self.np_starts, values, side='right') - 1
+        found = n >= 0
+        n[~found] = 0
+        if len(self.np_ends):
+            found &= values <= self.np_ends[n]
+            codes = numpy.where(found, self.np_codes[n], len(self.countries))
+        else:
+            codes = numpy.full(len(values), len(self.countries))
+
+        return codes
+
+
+    def lookup_many(self, addresses):
+        '''
+        Return list of countries for a sequence of IPv4 or IPv6 addresses
+        in the same order, None where not found or not a valid address.
+        With numpy IPv4 addresses are parsed and searched in batches with
+        vectorised operations, IPv6 and invalid addresses are parsed 
+        individually.
+        '''
+        addresses = list(addresses)
+        if self.use_numpy:
+            results = numpy.full(len(addresses), None, dtype=object)
+            for offset in range(0, len(addresses), LOOKUP_BATCH_SIZE):
+                batch = addresses[offset:offset + LOOKUP_BATCH_SIZE]
+                values, valid = ipv4_to_ints(batch)
+                found = results[offset:offset + len(batch)]
+                found[valid] = self.np_countries[
+                                   self.lookup_codes(values[valid])]
+                for n in numpy.flatnonzero(~valid).tolist():
+                    try:
+                        found[n] = self.lookup_int(*ip_to_int(batch[n]))
+                    except ValueError:
+                        pass
+            results = results.tolist()
+        else:
+            results = [ None ] * len(addresses)
+            for n, address in enumerate(addresses):
+                try:
+                    results[n] = self.lookup_int(*ip_to_int(address))
+                except ValueError:
+                    pass
+
+        return results
+
+
+class UInt128View:
+    '''
+    Read only sequence of 128 bit integers over arrays of the high and
+    low 64 bits, so IPv6 ranges can be searched with bisect in place
+    '''
+
+    def __init__(self, high, low):
+        self.high = high
+        self.low = low
+
+
+    def __len__(self):
+        return len(self.high)
+
+
+    def __getitem__(self, n):
+        return self.high[n] << 64 | self.low[n]
+
+
+class CountryDB(CountryLookup):
+    '''
+    Reader for a binary country database written by write_country_db().
+    The file is memory mapped read only and searched in place, so 
+    processes on a host share one copy of the data through the page
+    cache and opening the file is independent of its size. Lookups are
+    the same as CountryLookup.
+
+    The file is little endian: a header, a table of NUL separated 
+    country labels, then per IP version sorted range start and end 
+    arrays and an array of uint16 indexes in to the country table. 
+    IPv4 addresses are uint32, IPv6 addresses are split in to high and
+    low uint64 arrays. Each section starts on an 8 byte boundary.
+    '''
+
+    def __init__(self, filename, engine='auto'):
+        '''
+        Parameters:
+            filename (str): Database file
+            engine (str): auto, numpy or python. auto uses numpy if
+                          available for batch lookups
+
+        Raises:
+            IOError, ValueError if not a valid database
+        '''
+        if engine == 'numpy' and not numpy:
+            log.warning('numpy not available, using python engine')
+        self.use_numpy = bool(numpy) and engine in ('auto', 'numpy')
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < DB_HEADER.size:
+            raise ValueError(f'{filename} is not a country database')
+        (magic, version, _, no_countries, table_bytes, no_v4, no_v6, 
+         _, self.created) = DB_HEADER.unpack_from(self.mmap)
+        if magic != DB_MAGIC:
+            raise ValueError(f'{filename} is not a country database')
+        if version != DB_FORMAT_VERSION:
+            raise ValueError(f'{filename} is database format {version}, ' +
+                             f'expected {DB_FORMAT_VERSION}')
+        size = db_size(table_bytes, no_v4, no_v6)
+        if len(self.mmap) < size:
+            raise ValueError(f'{filename} is truncated')
+
+        offset = DB_HEADER.size
+        table = self.mmap[offset:offset + table_bytes].decode()
+        self.countries = tuple(table.split('\0')) if no_countries else ()
+        offset += db_padded(table_bytes)
+
+        self.starts = {}
+        self.ends = {}
+        self.codes = {}
+        self.starts[4], offset = db_array(self.mmap, offset, no_v4, 'I')
+        self.ends[4], offset = db_array(self.mmap, offset, no_v4, 'I')
+        self.codes[4], offset = db_array(self.mmap, offset, no_v4, 'H')
+        high, offset = db_array(self.mmap, offset, no_v6, 'Q')
+        low, offset = db_array(self.mmap, offset, no_v6, 'Q')
+        self.starts[6] = UInt128View(high, low)
+        high, offset = db_array(self.mmap, offset, no_v6, 'Q')
+        low, offset = db_array(self.mmap, offset, no_v6, 'Q')
+        self.ends[6] = UInt128View(high, low)
+        self.codes[6], offset = db_array(self.mmap, offset, no_v6, 'H')
+
+        if self.use_numpy:
+            # Views of the mapping, read only as the mapping is
+            offset = DB_HEADER.size + db_padded(table_bytes)
+            self.np_starts = numpy.frombuffer(self.mmap, dtype='<u4', 
+                                              count=no_v4, offset=offset)
+            offset += db_padded(no_v4 * 4)
+            self.np_ends = numpy.frombuffer(self.mmap, dtype='<u4', 
+                                            count=no_v4, offset=offset)
+            offset += db_padded(no_v4 * 4)
+            self.np_codes = numpy.frombuffer(self.mmap, dtype='<u2', 
+                                             count=no_v4, offset=offset)
+            self.np_countries = numpy.array(self.countries + (None,),
+                                            dtype=object)
+            self.np_countries.flags.writeable = False
+        log.debug(f'Mapped {filename}: {len(self)} ranges for ' +
+                  f'{len(self.countries)} countries')
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+    def close(self):
+        '''
+        Release the views and unmap the file
+        '''
+        self.starts = self.ends = self.codes = {}
+        self.np_starts = self.np_ends = self.np_codes = None
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Views still held by the caller, unmapped when released
+            pass
+
+        return
+
+
+class CountryService:
+    '''
+    Country IP dataset held in memory for the serve mode, with a 
+    CountryLookup index. refresh() retrieves the data again and swaps
+    in the new dataset only if every country was retrieved, so requests
+    always see a complete dataset.
+    '''
+
+    def __init__(self, b1td, countries, cache=None, workers=1, retry=None,
+                       aggregate=None, engine='auto'):
+        '''
+        Parameters:
+            b1td (obj): bloxone.b1td instance
+            countries (list): list of countries, [''] for all
+            cache (obj): Optional CountryCache instance
+            workers (int): Number of countries to retrieve in parallel
+            retry (obj): Optional RetryPolicy for the API calls
+            aggregate (str): Optional country or all, see 
+                             aggregate_subnets()
+            engine (str): Engine used for batch lookups
+        '''
+        self.b1td = b1td
+        self.countries = countries
+        self.cache = cache
+        self.workers = workers
+        self.retry = retry
+        self.aggregate = aggregate
+        self.engine = engine
+        self.subnets = []
+        self.index = CountryLookup([], engine=engine)
+        self.updated = None
+        self.errors = {}
+        self.lock = threading.Lock()
+
+
+    def refresh(self):
+        '''
+        Retrieve the dataset and rebuild the index
+
+        Returns:
+            bool: True if the dataset was replaced
+        '''
+        errors = {}
+        subnets = get_subnets(self.b1td, self.countries, 
+                              workers=self.workers, errors=errors,
+                              cache=self.cache, retry=self.retry)
+        if errors:
+            log.error(f'Refresh failed for {len(errors)} countries, ' +
+                      'keeping current dataset')
+            with self.lock:
+                self.errors = errors
+            return False
+        if self.aggregate:
+            subnets = list(aggregate_subnets(subnets, 
+                           across_countries=(self.aggregate == 'all')))
+        index = CountryLookup(subnets, engine=self.engine)
+        with self.lock:
+            self.subnets = subnets
+            self.index = index
+            self.updated = time.time()
+            self.errors = {}
+        log.info(f'Serving {len(subnets)} subnets, {len(index)} ranges')
+
+        return True
+
+
+    def snapshot(self):
+        '''
+        Return the current (subnets, index), consistent with each other
+        '''
+        with self.lock:
+            return self.subnets, self.index
+
+
+    def status(self):
+        '''
+        Return dict describing the dataset
+        '''
+        with self.lock:
+            status = { 'version': __version__,
+                       'subnets': len(self.subnets),
+                       'ranges': len(self.index),
+                       'countries': len(self.index.countries),
+                       'updated': self.updated,
+                       'errors': self.errors }
+        if self.retry:
+            status['retries'] = sum(self.retry.retries.values())
+
+        return status
+
 
 # ** Functions **
 
@@ -78,27 +1307,158 @@ def parseargs():
         Returns parsed arguments
     '''
     parse = argparse.ArgumentParser(description='B1TD Country IPs')
-    group = parse.add_mutually_exclusive_group(required=True)
+    group = parse.add_argument_group('outputs', 
+                                     'One or more outputs from a single ' +
+                                     'retrieval, -s and -n optionally take '+
+                                     'their own output file')
     parse.add_argument('-o', '--output', type=str,
                        help="Output to <filename>", default="")
+    parse.add_argument('--compress', type=str, default='auto',
+                       choices=['auto', 'gz', 'xz', 'zst', 'none'],
+                       help="Compress output file, auto selects from " +
+                            "the file extension")
+    parse.add_argument('-k', '--keep', type=int, default=0,
+                       help="Number of previous output files to keep")
     parse.add_argument('-c', '--config', type=str, default='bloxone.ini',
                        help="Overide Config file")
     parse.add_argument('-C', '--countries', type=str,
                        help="Country or list of comma delimited countries")
     # parse.add_argument('-a', '--append', action='store_true',
                        # help="Append data to existing custom list")
+    parse.add_argument('--sync', action='store_true',
+                       help="Update existing custom lists with only the " +
+                            "items added or removed")
+    parse.add_argument('--upload-workers', type=int, default=1,
+                       help="Number of custom lists to upload in parallel")
+    parse.add_argument('--rate', type=float, default=0,
+                       help="Maximum custom list uploads started per second")
+    parse.add_argument('--pack', action='store_true',
+                       help="Aggregate subnets before creating custom lists")
+    parse.add_argument('--by-country', action='store_true',
+                       help="Keep each country's subnets together when " +
+                            "splitting in to custom lists")
+    parse.add_argument('--per-country', action='store_true',
+                       help="Separate custom lists for each country")
+    parse.add_argument('--resume', action='store_true',
+                       help="Skip custom lists already uploaded by a " +
+                            "previous run and retry the rest")
+    parse.add_argument('--journal', type=str, default='',
+                       help="Custom list upload journal, defaults to " +
+                            "<custom_list>.journal in the cache directory")
+    parse.add_argument('--retries', type=int, default=DEFAULT_RETRY_ATTEMPTS,
+                       help="Maximum attempts per API call, 1 to disable " +
+                            "retries")
+    parse.add_argument('--max-backoff', type=float, 
+                       default=DEFAULT_RETRY_MAX_BACKOFF,
+                       help="Maximum seconds to wait between attempts")
+    parse.add_argument('--timeout', type=float, default=DEFAULT_READ_TIMEOUT,
+                       help="Seconds to wait for country data before " +
+                            "retrying")
     parse.add_argument('-p', '--policy', type=str,
                        help="Name of security policy to add custom lists")
+    parse.add_argument('-w', '--workers', type=int, default=1,
+                       help="Number of countries to retrieve in parallel")
+    parse.add_argument('--async', dest='use_async', action='store_true',
+                       help="Retrieve countries using asyncio, " +
+                            "--workers sets the concurrency limit")
+    parse.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                       help="Directory for cached country data")
+    parse.add_argument('--cache-ttl', type=int, default=DEFAULT_CACHE_TTL,
+                       help="Seconds cached country data is used for")
+    parse.add_argument('--no-cache', action='store_true',
+                       help="Do not use cached country data")
+    parse.add_argument('--refresh', action='store_true',
+                       help="Ignore cached data and retrieve again")
+    parse.add_argument('-a', '--aggregate', nargs='?', const='country',
+                       choices=['country', 'all'],
+                       help="Merge adjacent and overlapping subnets per " +
+                            "country (default) or across all countries")
+    parse.add_argument('--engine', type=str, default='auto',
+                       choices=['auto', 'numpy', 'python'],
+                       help="Engine used to split subnets in to /24s " +
+                            "for custom lists and for batch lookups")
+    parse.add_argument('--column', type=str, default='1',
+                       help="Field number, from 1, or header name of the " +
+                            "IP address to enrich (default 1)")
+    parse.add_argument('--delimiter', type=str, default=',',
+                       help="Field delimiter of the file to enrich, ' ' " +
+                            "for whitespace")
+    parse.add_argument('--header', action='store_true',
+                       help="File to enrich has a header line")
+    parse.add_argument('--processes', type=int, default=1,
+                       help="Number of processes used to enrich")
+    parse.add_argument('--watch', type=int, metavar='INTERVAL',
+                       help="Keep running, retrieving countries every " +
+                            "INTERVAL seconds and regenerating outputs " +
+                            "for changes")
+    parse.add_argument('--serve-interval', type=int, 
+                       default=DEFAULT_SERVE_INTERVAL,
+                       help="Seconds between dataset refreshes when " +
+                            "serving, 0 for none")
     parse.add_argument('-d', '--debug', action='store_true',
                        help="Enable debug messages")
     group.add_argument('-l', '--custom_list', type=str,
                        help="Base name for custom lists in BloxOne TD")
-    group.add_argument('-n', '--nios', action='store_true',
-                       help="NIOS RPZ CSV Output")
-    group.add_argument('-s', '--subnets', action='store_true',
-                       help="Output CIDR subnets in simple CSV")
-
-    return parse.parse_args()
+    group.add_argument('--serve', type=str, metavar='[HOST:]PORT',
+                       help="Serve lookups and CSV/NIOS exports over " +
+                            "HTTP, on 127.0.0.1 unless HOST is given")
+    group.add_argument('--db', type=str, metavar='FILE',
+                       help="Write a memory mapped binary country " +
+                            "database to FILE")
+    group.add_argument('--enrich', type=str, metavar='FILE',
+                       help="Append the country of the IP address in " +
+                            "--column to each line of FILE, - for stdin, " +
+                            "output to -o or stdout")
+    group.add_argument('--lookup', type=str, metavar='ADDRESSES',
+                       help="Look up the country of a comma delimited " +
+                            "list of IP addresses")
+    group.add_argument('-n', '--nios', type=str, nargs='?', const='',
+                       metavar='OUTPUT',
+                       help="NIOS RPZ CSV Output, to OUTPUT if specified")
+    group.add_argument('-s', '--subnets', type=str, nargs='?', const='',
+                       metavar='OUTPUT',
+                       help="Output CIDR subnets in simple CSV, to OUTPUT " +
+                            "if specified")
+
+    args = parse.parse_args()
+    if not (args.custom_list or args.nios is not None or 
+            args.subnets is not None or args.lookup or args.enrich or
+            args.db or args.serve):
+        parse.error('at least one of the arguments -l/--custom_list ' +
+                    '--serve --db --enrich --lookup -n/--nios ' +
+                    '-s/--subnets is required')
+    if args.serve:
+        if (args.custom_list or args.nios is not None or 
+            args.subnets is not None or args.lookup or args.enrich or 
+            args.db):
+            parse.error('--serve cannot be combined with other outputs')
+        host, _, port = args.serve.rpartition(':')
+        if not port.isdigit():
+            parse.error('--serve requires a port, [HOST:]PORT')
+        if ':' in host and not (host.startswith('[') and 
+                                host.endswith(']')):
+            parse.error('--serve IPv6 addresses must be in brackets, ' +
+                        '[::1]:PORT')
+    if (args.by_country or args.per_country) and args.aggregate == 'all':
+        # Merged subnets are labelled CN/HK, not a single country
+        parse.error('--by-country and --per-country cannot be used ' +
+                    'with --aggregate all')
+    if args.watch is not None:
+        if args.watch <= 0:
+            parse.error('--watch requires a positive interval')
+        if args.serve or args.lookup or args.enrich:
+            parse.error('--watch only applies to -l/--custom_list --db ' +
+                        '-n/--nios -s/--subnets')
+    if args.nios is not None and args.subnets is not None:
+        if (args.nios or args.output) == (args.subnets or args.output):
+            parse.error('-n/--nios and -s/--subnets require separate outputs')
+    if args.enrich:
+        if ((args.nios is not None and not args.nios) or
+            (args.subnets is not None and not args.subnets)):
+            parse.error('--enrich writes to -o/--output, -n/--nios and ' +
+                        '-s/--subnets require separate outputs')
+
+    return args
 
 
 def setup_logging(debug):
@@ -112,226 +1472,1432 @@ def setup_logging(debug):
         None.
 
     '''
-    # Set debug level
-    if debug:
-        logging.basicConfig(level=logging.DEBUG,
-                            format='%(asctime)s %(levelname)s: %(message)s')
+    # Set debug level
+    if debug:
+        logging.basicConfig(level=logging.DEBUG,
+                            format='%(asctime)s %(levelname)s: %(message)s')
+    else:
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s %(levelname)s: %(message)s')
+
+    return
+
+
+def output_compression(filename, compress='auto'):
+    '''
+    Determine compression for output file
+
+    Parameters:
+        filename (str): Name of output file
+        compress (str): auto, gz, xz, zst or none. auto selects from
+                        the file extension
+
+    Returns:
+        compression (str) gz, xz, zst or None
+    '''
+    if compress == 'auto':
+        ext = os.path.splitext(filename)[1].lower()
+        compression = COMPRESSION_EXTENSIONS.get(ext)
+    elif compress == 'none':
+        compression = None
+    else:
+        compression = compress
+
+    return compression
+
+
+def open_output(filename, compression=None, binary=False):
+    '''
+    Open text file for writing through a streaming compressor
+
+    Parameters:
+        filename (str): Name of file to open
+        compression (str): gz, xz, zst or None
+        binary (bool): Open for bytes rather than text
+
+    Returns:
+        file handler object
+
+    Raises:
+        IOError, ValueError if compression is unavailable
+    '''
+    mode = 'wb' if binary else 'wt'
+    if compression == 'gz':
+        handler = gzip.open(filename, mode=mode)
+    elif compression == 'xz':
+        handler = lzma.open(filename, mode=mode)
+    elif compression == 'zst':
+        if not zstandard:
+            raise ValueError('zstd compression requires the zstandard module')
+        handler = zstandard.open(filename, mode=mode)
+    else:
+        handler = open(filename, mode=mode)
+
+    return handler
+
+
+def open_input(filename):
+    '''
+    Open text file for reading, decompressing gz, xz and zst files
+    selected by the file extension. - reads stdin.
+
+    Parameters:
+        filename (str): Name of file to open
+
+    Returns:
+        file handler object
+
+    Raises:
+        IOError, ValueError if compression is unavailable
+    '''
+    if filename == '-':
+        return sys.stdin
+    compression = output_compression(filename)
+    if compression == 'gz':
+        handler = gzip.open(filename, mode='rt', errors='replace')
+    elif compression == 'xz':
+        handler = lzma.open(filename, mode='rt', errors='replace')
+    elif compression == 'zst':
+        if not zstandard:
+            raise ValueError('zstd compression requires the zstandard module')
+        handler = zstandard.open(filename, mode='rt', errors='replace')
+    else:
+        handler = open(filename, mode='r', errors='replace')
+
+    return handler
+
+
+def open_file(filename, compress='auto', keep=0, binary=False):
+    '''
+     Attempt to open file for output. Data is written to a temporary 
+     file and only replaces filename when the handler is closed.
+
+     Parameters:
+        filename (str): Name of file to open.
+        compress (str): auto, gz, xz, zst or none. auto selects from
+                        the file extension
+        keep (int): Number of previous generations of filename to keep
+        binary (bool): Open for bytes rather than text
+
+     Returns:
+        AtomicFile handler object.
+
+    '''
+    compression = output_compression(filename, compress=compress)
+    if compression:
+        log.info(f'Compressing output using {compression}')
+    try:
+        handler = AtomicFile(filename, compression=compression, keep=keep,
+                             binary=binary)
+        log.info("Successfully opened output file {}.".format(filename))
+    except (IOError, ValueError) as err:
+        log.error("{}".format(err))
+        handler = False
+
+    return handler
+
+
+def parse_countries(countries):
+    '''
+    Parse string in to list
+
+    Parameters:
+        countries (str): String from command line
+
+    Returns:
+        list of countries
+    '''
+    list_of_countries = []
+    if isinstance(countries, str):
+        list_of_countries = countries.split(',')
+    
+    return list_of_countries
+
+
+def iter_country_ips(chunks, key='country_ip'):
+    '''
+    Incrementally parse a country_ip response body, yielding each 
+    record as soon as it has been received. Only the unparsed tail of
+    the body is held in memory.
+
+    Parameters:
+        chunks (iterable): Raw response body as bytes chunks
+        key (str): Name of the array member holding the records
+
+    Yields:
+        dict {cidr, country}
+
+    Raises:
+        ValueError if the body ends part way through the array
+    '''
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    separators = re.compile(r'[\s,]*')
+    marker = f'"{key}"'
+    buf = ''
+    pos = 0
+    in_array = False
+
+    chunks = iter(chunks)
+    for chunk in chunks:
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+        if not in_array:
+            start = buf.find(marker)
+            if start < 0:
+                # Keep enough to match a marker split across chunks
+                buf = buf[-len(marker):]
+                continue
+            start = buf.find('[', start + len(marker))
+            if start < 0:
+                continue
+            pos = start + 1
+            in_array = True
+
+        while True:
+            pos = separators.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            if buf[pos] == ']':
+                # Drain the remainder so pass through consumers, such as
+                # the cache, see the complete body
+                for chunk in chunks:
+                    pass
+                return
+            try:
+                record, pos = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # Record incomplete, wait for more data
+                break
+            yield record
+
+    if in_array:
+        raise ValueError(f'Incomplete {key} data')
+
+    return
+
+
+def open_country_stream(b1td, country, cache=None, chunk_size=CHUNK_SIZE,
+                        retry=None):
+    '''
+    Open the country_ip data for a country as a stream of raw body 
+    chunks. Fresh cache entries are read from disk, otherwise a streamed 
+    request is made, conditional on any stale cache entry, and the body 
+    written through to the cache as it arrives.
+
+    Parameters:
+        b1td (obj): bloxone.b1td instance
+        country (str): Country name or ISO code
+        cache (obj): Optional CountryCache instance
+        chunk_size (int): Size of chunks to read
+        retry (obj): Optional RetryPolicy for the API calls
+
+    Returns:
+        tuple (chunks, error) where chunks is None on error
+
+    Raises:
+        bloxone.CountryISOCodeNotFound
+    '''
+    if retry is None:
+        retry = RetryPolicy(attempts=1)
+    if not country:
+        # Complete dataset
+        iso_code = ''
+    elif cache:
+        iso_code = cache.iso_code(b1td, country, retry=retry)
+    elif len(country) == 2:
+        iso_code = country
+    else:
+        iso_code = b1td.get_country_isocode(country=country)
+    if iso_code is None or (country and not iso_code):
+        raise bloxone.CountryISOCodeNotFound(f'No match for country: {country}')
+    key = iso_code or ALL_COUNTRIES_KEY
+
+    if cache and cache.is_fresh(key):
+        log.debug(f'Cache hit for {key}')
+        return cache.chunks(key, chunk_size), None
+
+    headers = dict(b1td.headers)
+    if cache:
+        headers.update(cache.validators(key))
+    response = retry.call(requests.request, 'GET', 
+                          country_ip_url(b1td, iso_code),
+                          headers=headers,
+                          stream=True,
+                          timeout=(DEFAULT_CONNECT_TIMEOUT, retry.timeout))
+    if response.status_code == 304 and cache:
+        response.close()
+        cache.touch(key)
+        return cache.chunks(key, chunk_size), None
+    elif response.status_code in b1td.return_codes_ok:
+        chunks = response.iter_content(chunk_size=chunk_size)
+        if cache:
+            chunks = cache.store_stream(key, chunks,
+                        etag=response.headers.get('ETag'),
+                        last_modified=response.headers.get('Last-Modified'))
+        return chunks, None
+    else:
+        return None, f'API error: {response.status_code} - {response.text}'
+
+
+def fetch_country(b1td, country, cache=None, retry=None):
+    '''
+    Retrieve the country_ips for a single country
+
+    Parameters:
+        b1td (obj): bloxone.b1td instance
+        country (str): Country name or ISO code
+        cache (obj): Optional CountryCache instance
+        retry (obj): Optional RetryPolicy for the API calls
+
+    Returns:
+        tuple (country, subnets, error) where error is None on success
+    '''
+    subnets = []
+    error = None
+    try:
+        if cache:
+            chunks, error = open_country_stream(b1td, country, cache,
+                                                retry=retry)
+            if not error:
+                subnets = list(iter_country_ips(chunks))
+        else:
+            if retry is None:
+                retry = RetryPolicy(attempts=1)
+            response = retry.call(b1td.get_country_ips, country)
+            if response.status_code in b1td.return_codes_ok:
+                subnets = response.json().get('country_ip')
+            else:
+                error = f'API error: {response.status_code} - {response.text}'
+    except bloxone.CountryISOCodeNotFound:
+        error = f'Country {country} not found.'
+    except (requests.exceptions.RequestException, OSError, ValueError) as err:
+        error = f'Failed to read data for {country}: {err}'
+
+    return country, subnets, error
+
+
+def iter_subnets(b1td, countries, errors=None, cache=None, workers=1,
+                 retry=None):
+    '''
+    Generator streaming subnets for list of countries. Records are 
+    parsed as each response arrives so they reach the output before 
+    the download completes, with memory use independent of response size.
+
+    With workers > 1 countries are retrieved in parallel and yielded in 
+    order, holding at most workers countries in memory at once.
+
+    Parameters:
+        b1td (obj): bloxone.b1td instance
+        countries (list): list of countries
+        errors (dict): Optional dict populated with {country: error}
+        cache (obj): Optional CountryCache instance
+        workers (int): Number of countries to retrieve in parallel
+        retry (obj): Optional RetryPolicy for the API calls
+
+    Yields:
+        dict {cidr, country}
+    '''
+    if workers > 1 and len(countries) > 1:
+        yield from iter_subnets_parallel(b1td, countries, errors=errors,
+                                         cache=cache, workers=workers,
+                                         retry=retry)
+        return
+
+    failed = []
+    logging.info('Retrieving country_ips')
+    for country in countries:
+        count = 0
+        try:
+            chunks, error = open_country_stream(b1td, country, cache,
+                                                retry=retry)
+            if not error:
+                for subnet in iter_country_ips(chunks):
+                    count += 1
+                    yield subnet
+        except bloxone.CountryISOCodeNotFound:
+            error = f'Country {country} not found.'
+        except (requests.exceptions.RequestException, OSError, 
+                ValueError) as err:
+            # Records already yielded cannot be recalled
+            error = (f'Failed to read data for {country} after ' +
+                     f'{count} records: {err}')
+
+        if error:
+            logging.error(error)
+            failed.append(country)
+            if errors is not None:
+                errors[country] = error
+        else:
+            logging.info(f'Retrieved {count} IPs for {country}')
+
+    if failed:
+        logging.error(f'Failed to retrieve {len(failed)} countries: ' +
+                      f'{", ".join(failed)}')
+
+    return
+
+
+def iter_subnets_parallel(b1td, countries, errors=None, cache=None, 
+                          workers=2, retry=None):
+    '''
+    Generator retrieving countries in parallel using a sliding window of 
+    workers requests, yielding subnets in the order of countries
+
+    Parameters:
+        b1td (obj): bloxone.b1td instance
+        countries (list): list of countries
+        errors (dict): Optional dict populated with {country: error}
+        cache (obj): Optional CountryCache instance
+        workers (int): Number of countries to retrieve in parallel
+        retry (obj): Optional RetryPolicy for the API calls
+
+    Yields:
+        dict {cidr, country}
+    '''
+    failed = []
+    logging.info('Retrieving country_ips')
+    logging.debug(f'Using {workers} workers')
+    pending = collections.deque()
+    remaining = iter(countries)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for country in itertools.islice(remaining, workers):
+            pending.append(pool.submit(fetch_country, b1td, country, cache,
+                                       retry))
+        while pending:
+            country, data, error = pending.popleft().result()
+            # Keep the window full before handing data downstream
+            for country_next in itertools.islice(remaining, 1):
+                pending.append(pool.submit(fetch_country, 
+                                           b1td, country_next, cache, retry))
+            if error:
+                logging.error(error)
+                failed.append(country)
+                if errors is not None:
+                    errors[country] = error
+            else:
+                logging.info(f'Retrieved {len(data)} IPs for {country}')
+                yield from data
+            del data
+
+    if failed:
+        logging.error(f'Failed to retrieve {len(failed)} countries: ' +
+                      f'{", ".join(failed)}')
+
+    return
+
+
+def get_subnets(b1td, countries, workers=1, errors=None, cache=None,
+                retry=None):
+    '''
+    Build list of subnets for list of countries
+
+    Parameters:
+        b1td (obj): bloxone.b1td instance
+        countries (list): list of countries
+        workers (int): Number of countries to retrieve in parallel
+        errors (dict): Optional dict populated with {country: error}
+        cache (obj): Optional CountryCache, fresh entries are served 
+                     from disk
+        retry (obj): Optional RetryPolicy for the API calls
+    
+    Returns:
+        subnets (list): List of dict {cidr, country}
+    '''
+    logging.info('Retrieving country_ips')
+    if workers > 1 and len(countries) > 1:
+        logging.debug(f'Using {workers} workers')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            # map() returns results in the order of countries
+            results = list(pool.map(lambda c: fetch_country(b1td, c, cache,
+                                                            retry), 
+                                    countries))
+    else:
+        results = (fetch_country(b1td, c, cache, retry) for c in countries)
+
+    subnets = merge_country_results(results, errors=errors)
+
+    return subnets
+
+
+def merge_country_results(results, errors=None):
+    '''
+    Combine per country results in to a single list of subnets
+
+    Parameters:
+        results (iterable): tuples of (country, subnets, error)
+        errors (dict): Optional dict populated with {country: error}
+
+    Returns:
+        subnets (list): List of dict {cidr, country}
+    '''
+    subnets = []
+    failed = []
+    for country, data, error in results:
+        if error:
+            logging.error(error)
+            failed.append(country)
+            if errors is not None:
+                errors[country] = error
+        else:
+            logging.info(f'Retrieved IPs for {country}')
+            subnets += data
+
+    if failed:
+        logging.error(f'Failed to retrieve {len(failed)} countries: ' +
+                      f'{", ".join(failed)}')
+
+    return subnets
+
+
+def country_ip_url(b1td, iso_code):
+    '''
+    Build the TIDE country_ip URL for an ISO code
+
+    Parameters:
+        b1td (obj): bloxone.b1td instance
+        iso_code (str): Two letter ISO code, empty for all countries
+
+    Returns:
+        url (str)
+    '''
+    url = f'{b1td.tide_url}/data/set/countryip'
+    if iso_code:
+        url += f'?country={iso_code}'
+
+    return url
+
+
+async def fetch_country_async(b1td, session, country, semaphore, cache=None,
+                              retry=None):
+    '''
+    Retrieve the country_ips for a single country using a shared
+    aiohttp session
+
+    Parameters:
+        b1td (obj): bloxone.b1td instance
+        session (obj): aiohttp.ClientSession
+        country (str): Country name or ISO code
+        semaphore (obj): asyncio.Semaphore limiting concurrent requests
+        cache (obj): Optional CountryCache instance
+        retry (obj): Optional RetryPolicy for the API calls
+
+    Returns:
+        tuple (country, subnets, error) where error is None on success
+    '''
+    subnets = []
+    error = None
+    if retry is None:
+        retry = RetryPolicy(attempts=1)
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        try:
+            subnets, error = await fetch_country_body(b1td, session, country,
+                                                      loop, cache, retry)
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                requests.exceptions.RequestException, 
+                OSError, ValueError) as err:
+            # Isolate the failure to this country as fetch_country does
+            subnets = []
+            error = f'Failed to read data for {country}: {err}'
+
+    return country, subnets, error
+
+
+async def fetch_country_body(b1td, session, country, loop, cache=None,
+                             retry=None):
+    '''
+    Retrieve and parse the country_ips for a single country, for 
+    fetch_country_async(). Cache reads and writes are blocking disk
+    I/O of the whole body, and parsing a large body takes long enough
+    to stall other requests, so both run in the default executor.
+
+    Returns:
+        tuple (subnets, error) where error is None on success
+
+    Raises:
+        aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError
+    '''
+    if not country:
+        iso_code = ''
+    elif cache:
+        iso_code = await loop.run_in_executor(None, cache.iso_code,
+                                              b1td, country, retry)
+    elif len(country) == 2:
+        iso_code = country
+    else:
+        # Name lookup uses the blocking client, keep it off the loop
+        iso_code = await loop.run_in_executor(None, 
+                                              b1td.get_country_isocode,
+                                              country)
+    if country and not iso_code:
+        return [], f'Country {country} not found.'
+    key = iso_code or ALL_COUNTRIES_KEY
+
+    headers = {}
+    if cache:
+        body = await loop.run_in_executor(None, cache.load, key)
+        if body is not None:
+            data = await loop.run_in_executor(None, json.loads, body)
+            return data.get('country_ip'), None
+        headers = await loop.run_in_executor(None, cache.validators, key)
+
+    async def request():
+        # The body cannot be read once the response is released
+        async with session.get(country_ip_url(b1td, iso_code),
+                               headers=headers) as response:
+            return types.SimpleNamespace(status=response.status,
+                                         headers=response.headers,
+                                         body=await response.read())
+
+    response = await retry.call_async(request)
+    if response.status == 304 and cache:
+        body = await loop.run_in_executor(None, cache.revalidated, key)
+        if body is None:
+            return [], f'Cache entry for {key} unreadable after 304'
+        data = await loop.run_in_executor(None, json.loads, body)
+        return data.get('country_ip'), None
+    elif response.status in b1td.return_codes_ok:
+        data = await loop.run_in_executor(None, json.loads, response.body)
+        subnets = data.get('country_ip')
+        if cache:
+            await loop.run_in_executor(None, functools.partial(
+                cache.store, key, response.body,
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified')))
+        return subnets, None
+    else:
+        text = response.body.decode(errors='replace')
+        return [], f'API error: {response.status} - {text}'
+
+
+async def get_subnets_async(b1td, countries, concurrency=10, 
+                            errors=None, cache=None, retry=None):
+    '''
+    Build list of subnets for list of countries without blocking the 
+    event loop. All requests are issued together over a single shared 
+    session, limited to concurrency requests in flight. If aiohttp is not 
+    installed the blocking client is run in the default executor.
+
+    Parameters:
+        b1td (obj): bloxone.b1td instance
+        countries (list): list of countries
+        concurrency (int): Maximum number of requests in flight
+        errors (dict): Optional dict populated with {country: error}
+        cache (obj): Optional CountryCache, fresh entries are served 
+                     from disk
+        retry (obj): Optional RetryPolicy for the API calls
+
+    Returns:
+        subnets (list): List of dict {cidr, country}
+    '''
+    logging.info('Retrieving country_ips')
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    if aiohttp:
+        timeout = aiohttp.ClientTimeout(total=None,
+                      sock_connect=DEFAULT_CONNECT_TIMEOUT,
+                      sock_read=retry.timeout if retry else 
+                                DEFAULT_READ_TIMEOUT)
+        async with aiohttp.ClientSession(headers=b1td.headers,
+                                         timeout=timeout) as session:
+            tasks = [ fetch_country_async(b1td, session, c, semaphore, cache,
+                                          retry)
+                      for c in countries ]
+            # gather() returns results in the order of countries
+            results = await asyncio.gather(*tasks)
+    else:
+        logging.debug('aiohttp not available, using executor')
+        loop = asyncio.get_running_loop()
+
+        async def fetch(country):
+            async with semaphore:
+                return await loop.run_in_executor(None, fetch_country, 
+                                                  b1td, country, cache,
+                                                  retry)
+
+        results = await asyncio.gather(*[ fetch(c) for c in countries ])
+
+    subnets = merge_country_results(results, errors=errors)
+
+    return subnets
+
+
+def parse_cidr(cidr):
+    '''
+    Parse CIDR notation to integer form without creating ipaddress 
+    objects
+
+    Parameters:
+        cidr (str): IPv4 or IPv6 subnet in CIDR notation
+
+    Returns:
+        tuple (version, network, prefixlen) with network as an integer
+
+    Raises:
+        ValueError if not a valid network
+    '''
+    address, _, prefix = cidr.partition('/')
+    try:
+        if ':' in address:
+            version, bits = 6, 128
+            network = int.from_bytes(
+                socket.inet_pton(socket.AF_INET6, address), 'big')
+        else:
+            version, bits = 4, 32
+            network = int.from_bytes(
+                socket.inet_pton(socket.AF_INET, address), 'big')
+    except OSError:
+        raise ValueError(f'{cidr} does not appear to be an IPv4 or IPv6 network')
+
+    prefixlen = int(prefix) if prefix else bits
+    if not 0 <= prefixlen <= bits:
+        raise ValueError(f'{cidr} has an invalid prefix length')
+    if network & ((1 << (bits - prefixlen)) - 1):
+        raise ValueError(f'{cidr} has host bits set')
+
+    return version, network, prefixlen
+
+
+def ip_to_int(address):
+    '''
+    Parse an IP address to integer form
+
+    Parameters:
+        address (str): IPv4 or IPv6 address
+
+    Returns:
+        tuple (version, value)
+
+    Raises:
+        ValueError if not a valid address
+    '''
+    try:
+        if ':' in address:
+            return 6, int.from_bytes(
+                socket.inet_pton(socket.AF_INET6, address), 'big')
+        else:
+            return 4, int.from_bytes(
+                socket.inet_pton(socket.AF_INET, address), 'big')
+    except (OSError, TypeError):
+        raise ValueError(f'{address} does not appear to be an IPv4 or ' +
+                         'IPv6 address')
+
+
+def ipv4_to_ints(addresses):
+    '''
+    Parse a batch of IPv4 addresses to integers with vectorised numpy
+    operations over the newline joined text of the batch. Only dotted
+    quads without leading zeros are accepted, as with ip_to_int(). 
+    Requires numpy.
+
+    Parameters:
+        addresses (list): IPv4 addresses as str
+
+    Returns:
+        tuple (values, valid) numpy arrays of uint32 addresses and 
+        whether each was a valid IPv4 address. None are valid if any
+        address is not a str or contains a newline, the caller then
+        parses them individually.
+    '''
+    values = numpy.zeros(len(addresses), dtype=numpy.uint32)
+    valid = numpy.zeros(len(addresses), dtype=bool)
+    try:
+        text = '\n'.join(addresses) + '\n'
+    except TypeError:
+        # Not all str, none are marked valid
+        text = ''
+    # Other characters become ? so positions still match
+    chars = numpy.frombuffer(text.encode('ascii', errors='replace'), 
+                             dtype=numpy.uint8)
+    is_end = chars == ord('\n')
+    ends = numpy.flatnonzero(is_end)
+    if len(ends) == len(addresses):
+        valid[:] = True
+        is_dot = chars == ord('.')
+        # uint8 wraps so one comparison checks for a digit
+        bad = ~((chars - ord('0') < 10) | is_dot | is_end)
+        # Address of a position is the first end at or after it
+        valid[numpy.searchsorted(ends, numpy.flatnonzero(bad))] = False
+
+        # Each octet is the digits before a dot or end, valid addresses
+        # have exactly four
+        terms = numpy.flatnonzero(is_dot | is_end)
+        term_ends = is_end[terms]
+        owner = numpy.cumsum(term_ends) - term_ends
+        counts = numpy.bincount(owner, minlength=len(addresses))
+        valid &= counts == 4
+        lengths = numpy.diff(terms, prepend=-1) - 1
+        digits = [ chars[terms - n].astype(numpy.int32) - ord('0')
+                   for n in (1, 2, 3) ]
+        octets = (digits[0] + 
+                  numpy.where(lengths >= 2, digits[1] * 10, 0) +
+                  numpy.where(lengths >= 3, digits[2] * 100, 0))
+        # No leading zeros
+        ok = ((lengths >= 1) & (lengths <= 3) & (octets <= 255) &
+              ~((lengths > 1) & (chars[terms - lengths] == ord('0'))))
+        valid[owner[~ok]] = False
+
+        rows = numpy.flatnonzero(valid)
+        first = (numpy.cumsum(counts) - counts)[rows]
+        quads = octets[first[:, None] + numpy.arange(4)].astype(numpy.uint32)
+        values[rows] = ((quads[:, 0] << 24) | (quads[:, 1] << 16) | 
+                        (quads[:, 2] << 8) | quads[:, 3])
+
+    return values, valid
+
+
+def cidr_to_range(cidr):
+    '''
+    Convert CIDR notation to an integer address range
+
+    Parameters:
+        cidr (str): IPv4 or IPv6 subnet in CIDR notation
+
+    Returns:
+        tuple (version, start, end)
+
+    Raises:
+        ValueError if not a valid network
+    '''
+    version, start, prefixlen = parse_cidr(cidr)
+    bits = 32 if version == 4 else 128
+
+    return version, start, start | ((1 << (bits - prefixlen)) - 1)
+
+
+def int_to_ip(version, value):
+    '''
+    Convert integer to IP address text
+
+    Parameters:
+        version (int): 4 or 6
+        value (int): Address as integer
+
+    Returns:
+        address (str) in compressed form
+    '''
+    if version == 4:
+        return (f'{value >> 24}.{value >> 16 & 255}.' +
+                f'{value >> 8 & 255}.{value & 255}')
+    else:
+        return ipaddress.IPv6Address(value).compressed
+
+
+def range_to_cidrs(version, start, end):
+    '''
+    Generator returning the minimal set of CIDRs covering an address range
+
+    Parameters:
+        version (int): 4 or 6
+        start (int): First address of range
+        end (int): Last address of range
+
+    Yields:
+        cidr (str)
+    '''
+    bits = 32 if version == 4 else 128
+    while start <= end:
+        # Largest block aligned on start that does not pass end
+        if start:
+            step = (start & -start).bit_length() - 1
+        else:
+            step = bits
+        step = min(step, (end - start + 1).bit_length() - 1)
+        yield f'{int_to_ip(version, start)}/{bits - step}'
+        start += 1 << step
+
+    return
+
+
+def merge_ranges(ranges):
+    '''
+    Merge adjacent and overlapping ranges
+
+    Parameters:
+        ranges (list): (start, end, label) tuples, sorted in place
+
+    Returns:
+        list of (start, end, labels) where labels is the set of labels
+        contributing to each merged range
+    '''
+    merged = []
+    ranges.sort()
+    for start, end, label in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+            merged[-1][2].add(label)
+        else:
+            merged.append([start, end, { label }])
+
+    return merged
+
+
+def flatten_ranges(ranges):
+    '''
+    Flatten nested ranges in to disjoint ranges where the innermost, 
+    most specific, range wins. Adjacent ranges with the same label are
+    joined.
+
+    Parameters:
+        ranges (list): (start, end, label) tuples, sorted in place
+
+    Returns:
+        list of [start, end, label] sorted by start
+    '''
+    flat = []
+
+    def emit(start, end, label):
+        if flat and flat[-1][1] + 1 == start and flat[-1][2] == label:
+            flat[-1][1] = end
+        else:
+            flat.append([start, end, label])
+
+    # Outer ranges sort before the ranges nested within them
+    ranges.sort(key=lambda r: (r[0], -r[1]))
+    enclosing = []
+    position = 0
+    for start, end, label in ranges:
+        # Finish enclosing ranges that end before this range
+        while enclosing and enclosing[-1][0] < start:
+            outer_end, outer_label = enclosing.pop()
+            if position <= outer_end:
+                emit(position, outer_end, outer_label)
+                position = outer_end + 1
+        if enclosing and position < start:
+            emit(position, start - 1, enclosing[-1][1])
+        position = max(position, start)
+        enclosing.append((end, label))
+    while enclosing:
+        outer_end, outer_label = enclosing.pop()
+        if position <= outer_end:
+            emit(position, outer_end, outer_label)
+            position = outer_end + 1
+
+    return flat
+
+
+def aggregate_subnets(subnets, across_countries=False):
+    '''
+    Collapse adjacent and overlapping subnets in to the minimal covering
+    set of CIDRs using integer ranges, O(n log n) in the number of 
+    subnets. All subnets are collected before output as aggregation 
+    needs the complete set.
+
+    Parameters:
+        subnets (iterable): dict {cidr, country}
+        across_countries (bool): Merge across countries, merged subnets 
+                                 are labelled with all contributing 
+                                 countries separated by /
+
+    Yields:
+        dict {cidr, country}
+    '''
+    # { country: { version: [ (start, end, country) ] } }
+    groups = {}
+    count = 0
+    logging.info('Aggregating subnets')
+    for subnet in subnets:
+        version, start, end = cidr_to_range(subnet.get('cidr'))
+        country = subnet.get('country')
+        group = '' if across_countries else country
+        groups.setdefault(group, { 4: [], 6: [] })[version].append(
+            (start, end, country))
+        count += 1
+
+    output = 0
+    for ranges in groups.values():
+        for version in (4, 6):
+            for start, end, countries in merge_ranges(ranges[version]):
+                country = '/'.join(sorted(countries))
+                for cidr in range_to_cidrs(version, start, end):
+                    output += 1
+                    yield { 'cidr': cidr, 'country': country }
+            ranges[version] = []
+
+    logging.info(f'Aggregated {count} subnets to {output}')
+
+    return
+
+
+def format_csv_row(subnet):
+    '''
+    Format subnet as a simple CSV row
+
+    Parameters:
+        subnet (dict): {cidr, country}
+
+    Returns:
+        row (str) including line ending
+    '''
+    return f"{subnet.get('cidr', '')},{subnet.get('country', '')}\n"
+
+
+def format_nios_row(subnet, zone='countryips.rpz.local', 
+                    parent='local.rpz.countryips', 
+                    view='default'):
+    '''
+    Format subnet as a NIOS RPZ CSV Import row
+
+    Parameters:
+        subnet (dict): {cidr, country}
+        zone (str): rpz zone name
+        parent (str): zone with labels reversed
+        view (str): DNS view
+
+    Returns:
+        row (str) including line ending
+    '''
+    cidr = '.'.join(reversed(subnet.get('cidr').replace('/', '.').split('.')))
+
+    return ( f'responsepolicycnamerecord,{cidr}.{zone},,,' +
+             f'Country: {subnet.get("country")},False,{parent},,{view}\n' )
+
+
+def csv_writer(outfile=None):
+    '''
+    Start simple CSV output
+
+    Parameters:
+        outfile (obj): filehandler
+
+    Returns:
+        RowWriter formatting subnets as simple CSV rows
+    '''
+    writer = RowWriter(outfile, formatter=format_csv_row)
+    if outfile:
+        log.debug(f'Outputting header data to file: {outfile}')
+    else:
+        log.debug(f'Outputting header data to stdout')
+    writer.write(','.join(CSV_HEADERS) + '\n')
+
+    return writer
+
+
+def nios_writer(outfile=None, zone='countryips.rpz.local', view='default'):
+    '''
+    Start NIOS RPZ CSV Import output
+
+    Parameters:
+        outfile (obj): filehandler
+        zone (str): rpz zone name
+        view (str): DNS view
+
+    Returns:
+        RowWriter formatting subnets as NIOS rows
+    '''
+    parent = bloxone.utils.reverse_labels(zone)
+    writer = RowWriter(outfile, 
+                       formatter=functools.partial(format_nios_row, 
+                                                   zone=zone,
+                                                   parent=parent,
+                                                   view=view))
+    writer.write(NIOS_HEADER + '\n')
+
+    return writer
+
+
+def output_csv(subnets, outfile=None):
+    '''
+    Output IP list as CSV
+
+    Parameters:
+        subnets (iterable of dict): IP subnets
+        outfile (obj): filehandler
+    '''
+    log.debug('Building CSV from IP List dataset')
+    writer = csv_writer(outfile)
+    
+    # Output CSV Data
+    log.debug('Generating simple CSV rows')
+    writer.writerows(map(writer.formatter, subnets))
+            
+    return
+
+
+def output_nios_csv(subnets, 
+                    zone='countryips.rpz.local', 
+                    view='default',
+                    outfile=None):
+    '''
+    Create CSV in NIOS RPZ Import format
+
+    Parameters:
+        subnets (iterable): dict of subnets
+        zone (str): rpz zone name
+        view (str): DNS view
+        outfile (obj): filehandler
+
+    '''
+    writer = nios_writer(outfile, zone=zone, view=view)
+
+    # Process subnets and generate CSV lines
+    writer.writerows(map(writer.formatter, subnets))
+
+    return
+
+
+def fan_out(subnets, consumers):
+    '''
+    Pass each subnet to every consumer in a single pass, so one 
+    retrieval can feed several outputs
+
+    Parameters:
+        subnets (iterable): dict {cidr, country}
+        consumers (list): callables accepting a subnet
+
+    Returns:
+        count (int) of subnets
+    '''
+    count = 0
+    for subnet in subnets:
+        for consumer in consumers:
+            consumer(subnet)
+        count += 1
+
+    return count
+
+
+def init_enrich(index, column=0, delimiter=','):
+    '''
+    Set the lookup index and options used by enrich_chunk(), run in 
+    each worker process
+
+    Parameters:
+        index (obj): CountryLookup instance
+        column (int): Field holding the IP address, from 0
+        delimiter (str): Field delimiter, whitespace if ' '
+    '''
+    enrich_state['index'] = index
+    enrich_state['column'] = column
+    enrich_state['delimiter'] = delimiter
+
+    return
+
+
+def enrich_chunk(lines):
+    '''
+    Append the country of the IP address in the selected field to 
+    each line, empty where the address is not found or not valid
+
+    Parameters:
+        lines (list): Lines of input including line endings
+
+    Returns:
+        tuple (lines, found) where found is the number of lines matched
+    '''
+    index = enrich_state['index']
+    column = enrich_state['column']
+    delimiter = enrich_state['delimiter']
+    lines = [ line.rstrip('\r\n') for line in lines ]
+    if delimiter == ' ':
+        rows = (line.split() for line in lines)
     else:
-        logging.basicConfig(level=logging.INFO,
-                            format='%(asctime)s %(levelname)s: %(message)s')
+        # csv handles quoted fields
+        rows = csv.reader(lines, delimiter=delimiter)
+    addresses = [ row[column].strip(' "[]') if len(row) > column else ''
+                  for row in rows ]
+    countries = index.lookup_many(addresses)
+    found = len(countries) - countries.count(None)
+    lines = [ f'{line}{delimiter}{country or ""}\n' 
+              for line, country in zip(lines, countries) ]
 
-    return
+    return lines, found
 
 
-def open_file(filename):
+def enrich_file(index, infile, outfile=None, column='1', delimiter=',',
+                header=False, processes=1, chunk_lines=ENRICH_CHUNK_LINES):
     '''
-     Attempt to open file for output
+    Stream a log or CSV file appending the country of the IP address
+    in column to each line. Input is processed in chunks of lines, in 
+    parallel across processes if more than one, and written in order.
 
-     Parameters:
-        filename (str): Name of file to open.
+    Parameters:
+        index (obj): CountryLookup instance
+        infile (obj): Input file handler
+        outfile (obj): Output file handler, stdout if not set
+        column (str): Field number from 1, or name of a header field
+        delimiter (str): Field delimiter, whitespace if ' '
+        header (bool): First line is a header, implied if column is 
+                       a name
+        processes (int): Number of processes to enrich chunks
+        chunk_lines (int): Number of lines per chunk
 
-     Returns:
-        file handler object.
+    Returns:
+        tuple (lines, found)
 
+    Raises:
+        ValueError if column is not found
     '''
-    if os.path.isfile(filename):
-        backup = filename+".bak"
-        try:
-            shutil.move(filename, backup)
-            log.info("Outfile exists moved to {}".format(backup))
-            try:
-                handler = open(filename, mode='w')
-                log.info("Successfully opened output file {}.".format(filename))
-            except IOError as err:
-                log.error("{}".format(err))
-                handler = False
-        except shutil.Error:
-            log.warning("Could not back up existing file {}, "
-                        "exiting.".format(filename))
-            handler = False
+    outfile = outfile or sys.stdout
+    total = 0
+    matched = 0
+    if header or not column.isdigit():
+        first = infile.readline()
+        if delimiter == ' ':
+            fields = first.split()
+        else:
+            fields = next(csv.reader([ first ], delimiter=delimiter), [])
+        if not column.isdigit():
+            if column not in fields:
+                raise ValueError(f'Column {column} not found in header')
+            column = str(fields.index(column) + 1)
+        outfile.write(first.rstrip('\r\n') + f'{delimiter}country\n')
+    column = int(column) - 1
+    if column < 0:
+        raise ValueError('Column numbers start from 1')
+
+    chunks = iter(lambda: list(itertools.islice(infile, chunk_lines)), [])
+    if processes > 1:
+        logging.debug(f'Enriching using {processes} processes')
+        with multiprocessing.Pool(processes, initializer=init_enrich,
+                                  initargs=(index, column, delimiter)) as pool:
+            # Sliding window keeps at most 2 chunks per process in memory
+            pending = collections.deque()
+            for chunk in itertools.islice(chunks, processes * 2):
+                pending.append(pool.apply_async(enrich_chunk, (chunk,)))
+            while pending:
+                lines, found = pending.popleft().get()
+                for chunk in itertools.islice(chunks, 1):
+                    pending.append(pool.apply_async(enrich_chunk, (chunk,)))
+                outfile.writelines(lines)
+                total += len(lines)
+                matched += found
     else:
-        try:
-            handler = open(filename, mode='w')
-            log.info("Successfully opened output file {}.".format(filename))
-        except IOError as err:
-            log.error("{}".format(err))
-            handler = False
+        init_enrich(index, column, delimiter)
+        for chunk in chunks:
+            lines, found = enrich_chunk(chunk)
+            outfile.writelines(lines)
+            total += len(lines)
+            matched += found
 
-    return handler
+    logging.info(f'Enriched {total} lines, {matched} with a country')
 
+    return total, matched
 
-def parse_countries(countries):
+
+def db_padded(size):
     '''
-    Parse string in to list
+    Return size rounded up to the 8 byte section alignment
+    '''
+    return (size + 7) & ~7
 
-    Parameters:
-        countries (str): String from command line
 
-    Returns:
-        list of countries
+def db_size(table_bytes, no_v4, no_v6):
     '''
-    list_of_countries = []
-    if isinstance(countries, str):
-        list_of_countries = countries.split(',')
-    
-    return list_of_countries
+    Return the size in bytes of a country database
+    '''
+    return (DB_HEADER.size + db_padded(table_bytes) + 
+            2 * db_padded(no_v4 * 4) + db_padded(no_v4 * 2) +
+            4 * db_padded(no_v6 * 8) + db_padded(no_v6 * 2))
 
 
-def get_subnets(b1td, countries):
+def db_array(buffer, offset, count, typecode):
     '''
-    Build list of subnets for list of countries
+    Return a little endian array from a database buffer without 
+    copying, other than on big endian hosts
 
     Parameters:
-        b1td (obj): bloxone.b1td instance
-        countries (list): list of countries
-    
+        buffer (obj): Object supporting the buffer protocol
+        offset (int): Start of array
+        count (int): Number of items
+        typecode (str): array module type code
+
     Returns:
-        subnets (list): List of dict {cidr, country}
+        tuple (sequence, offset of the next section)
     '''
-    subnets = []
-    logging.info('Retrieving country_ips')
-    for country in countries:
-        try:
-            response = b1td.get_country_ips(country)
-            if response.status_code in b1td.return_codes_ok:
-                logging.info(f'Retrieved IPs for {country}')
-                subnets += response.json().get('country_ip')
-            else:
-                logging.error(f'API error: {response.status_code} - ' +
-                              f'{response.text}')
-        except bloxone.CountryISOCodeNotFound:
-            logging.error(f'Country {country} not found.')
+    size = array.array(typecode).itemsize
+    view = memoryview(buffer)[offset:offset + count * size]
+    if sys.byteorder == 'little':
+        values = view.cast(typecode)
+    else:
+        values = array.array(typecode, view.tobytes())
+        values.byteswap()
 
-    return subnets
+    return values, offset + db_padded(count * size)
 
 
-def output_csv(subnets, outfile=None):
+def db_pack(typecode, values):
     '''
-    Output IP list as CSV
+    Return values as little endian bytes padded to section alignment
+    '''
+    values = array.array(typecode, values)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    data = values.tobytes()
 
-    Parameters:
-        subnets (list of dict): IP subnet list
-        outfile (obj): filehandler
+    return data + bytes(db_padded(len(data)) - len(data))
+
+
+def write_country_db(index, outfile):
     '''
-    csvrow = ""
-    csvheader = ""
-    csvrow = ""
+    Write a CountryLookup index as a binary country database for use
+    with CountryDB
 
-    headers = [ 'cidr', 'country' ]
-    
-    log.debug('Building CSV from IP List dataset')
-    # Build Header String
-    for item in headers:
-        csvheader += item + ','
+    Parameters:
+        index (obj): CountryLookup instance
+        outfile (obj): Binary file handler
 
-    # Trim final comma
-    csvheader = csvheader[:-1]
+    Returns:
+        size (int) of the database in bytes
+    '''
+    if len(index.countries) > 0xffff:
+        raise ValueError('Too many countries for a country database')
+    table = '\0'.join(index.countries).encode()
+    no_v4 = len(index.starts[4])
+    no_v6 = len(index.starts[6])
+    mask = (1 << 64) - 1
+    outfile.write(DB_HEADER.pack(DB_MAGIC, DB_FORMAT_VERSION, 0,
+                                 len(index.countries), len(table), 
+                                 no_v4, no_v6, 0, int(time.time())))
+    outfile.write(table + bytes(db_padded(len(table)) - len(table)))
+    outfile.write(db_pack('I', index.starts[4]))
+    outfile.write(db_pack('I', index.ends[4]))
+    outfile.write(db_pack('H', index.codes[4]))
+    for values in (index.starts[6], index.ends[6]):
+        outfile.write(db_pack('Q', (v >> 64 for v in values)))
+        outfile.write(db_pack('Q', (v & mask for v in values)))
+    outfile.write(db_pack('H', index.codes[6]))
+    size = db_size(len(table), no_v4, no_v6)
+    logging.info(f'Country database of {no_v4 + no_v6} ranges, ' +
+                 f'{size} bytes')
+
+    return size
+
+
+def process_subnets(subnets, engine='auto'):
+    '''
+    Process subnets to break subnets larger than /24 in to /24s
+    This is due to custom_list subnet limitations
 
-    # Output CSV Header
-    if outfile:
-        log.debug(f'Outputting header data to file: {outfile}')
-        print(csvheader, file=outfile)
-    else:
-        log.debug(f'Outputting header data to stdout')
-        print(csvheader)
+    Parameters:
+        subnets (iterable): country_ips
+        engine (str): auto, numpy or python. auto uses numpy if available
     
-    # Ootput CSV Data
-    log.debug('Generating simple CSV rows')
-    for subnet in subnets:
-        csvrow = ""
-        # Build CSV Row
-        for column in headers:
-            if column in subnet.keys():
-                csvrow += str(subnet[column]) + ','
-            else:
-                csvrow += ','
-        csvrow = csvrow[:-1]
+    Yields:
+        subnets in the form {"item": "<subnet>", "description": "<isocode>"}
+    '''
+    if engine == 'numpy' and not numpy:
+        logging.warning('numpy not available, using python engine')
+    if engine in ('auto', 'numpy') and numpy:
+        yield from process_subnets_numpy(subnets)
+        return
 
-        if outfile:
-            print(csvrow, file=outfile)
+    logging.info('Processing subnets')
+    for subnet in subnets:
+        # Work with integers, text is only generated for the output
+        version, network, prefixlen = parse_cidr(subnet.get('cidr'))
+        country = subnet.get('country')
+        if version == 4 and prefixlen < 24:
+            # Break in to /24s
+            first = network >> 8
+            for n in range(first, first + (1 << (24 - prefixlen))):
+                yield { "item": f'{n >> 16}.{n >> 8 & 255}.{n & 255}.0/24',
+                        "description": country }
         else:
-            print(csvrow)
-            
+            # Use as is, assume IPv6 is used as is
+            yield { "item": f'{int_to_ip(version, network)}/{prefixlen}',
+                    "description": country }
+    
     return
 
 
-def output_nios_csv(subnets, 
-                    zone='countryips.rpz.local', 
-                    view='default',
-                    outfile=None):
+@functools.lru_cache(maxsize=None)
+def octet_tables():
     '''
-    Create CSV in NIOS RPZ Import format
+    Lookup tables used to render /24s from their 24 bit index
 
-    Parameters:
-        subnets (list): List of dict of subnets
-        zone (str): rpz zone name
-        rpz_parent (str): RPZ parent zone
+    Returns:
+        tuple of numpy object arrays ("a.b." for 0-65535, "c.0/24" for 0-255)
+    '''
+    high = numpy.array([ f'{i >> 8}.{i & 255}.' for i in range(65536) ], 
+                       dtype=object)
+    low = numpy.array([ f'{i}.0/24' for i in range(256) ], dtype=object)
+
+    return high, low
 
+
+def process_subnets_numpy(subnets, batch_size=EXPAND_BATCH_SIZE):
     '''
-    reverse_labels= bloxone.utils.reverse_labels(zone)
+    Vectorised version of process_subnets, expanding subnets in batches
+    of up to batch_size items with numpy. Output is identical to the 
+    python engine.
 
-    # Print CSV Header
-    if outfile:
-        print('header-responsepolicycnamerecord,fqdn*,_new_fqdn,canonical_name,' +
-              'comment,disabled,parent_zone,ttl,view', file=outfile)
-    else:
-        print('header-responsepolicycnamerecord,fqdn*,_new_fqdn,canonical_name,' +
-              'comment,disabled,parent_zone,ttl,view')
+    Parameters:
+        subnets (iterable): country_ips
+        batch_size (int): Approximate number of items per batch
 
-    # Process subnets and generate CSV lines
+    Yields:
+        subnets in the form {"item": "<subnet>", "description": "<isocode>"}
+    '''
+    batch = []
+    items = 0
+    logging.info('Processing subnets (numpy)')
     for subnet in subnets:
-        cidr = subnet.get('cidr')
-        country = subnet.get('country')
-        cidr = bloxone.utils.reverse_labels(cidr.replace('/', '.'))
-
-        line = ( f'responsepolicycnamerecord,{cidr}.{zone},,,Country: {country},False,' +
-                 f'{reverse_labels},,{view}' )
-        
-        if outfile:
-            print(line, file=outfile)
+        version, network, prefixlen = parse_cidr(subnet.get('cidr'))
+        batch.append((version, network, prefixlen, subnet.get('country')))
+        if version == 4 and prefixlen < 24:
+            items += 1 << (24 - prefixlen)
         else:
-            print(line)
+            items += 1
+        if items >= batch_size:
+            yield from expand_batch_numpy(batch)
+            batch = []
+            items = 0
+    if batch:
+        yield from expand_batch_numpy(batch)
 
     return
 
 
-def process_subnets(subnets):
+def expand_batch_numpy(batch):
     '''
-    Process subnets to break subnets larger than /24 in to /24s
-    This is due to custom_list subnet limitations
+    Expand a batch of parsed subnets in to /24s using array arithmetic
 
     Parameters:
-        subnets (list): list of country_ips
-    
-    Returns:
-        list of subnets [ {"item": "<subnet>", "description": "<isocode>"} ]
+        batch (list): (version, network, prefixlen, country) tuples
+
+    Yields:
+        subnets in the form {"item": "<subnet>", "description": "<isocode>"}
     '''
-    items_described = []
+    expand = numpy.fromiter((v == 4 and p < 24 for v, n, p, c in batch),
+                            dtype=bool, count=len(batch))
+    prefixes = numpy.fromiter((p if e else 24 for (v, n, p, c), e 
+                               in zip(batch, expand)),
+                              dtype=numpy.int64, count=len(batch))
+    firsts = numpy.fromiter((n >> 8 if e else 0 for (v, n, p, c), e 
+                             in zip(batch, expand)),
+                            dtype=numpy.int64, count=len(batch))
+    counts = numpy.left_shift(1, 24 - prefixes)
+    offsets = numpy.cumsum(counts) - counts
+
+    # Source row and /24 index for every output item
+    rows = numpy.repeat(numpy.arange(len(batch)), counts)
+    index = firsts[rows] + (numpy.arange(len(rows)) - offsets[rows])
+
+    high, low = octet_tables()
+    output = numpy.empty(len(rows), dtype=object)
+    expanded = expand[rows]
+    index = index[expanded]
+    output[expanded] = high[index >> 8] + low[index & 255]
+    # Subnets used as is
+    output[offsets[~expand]] = [ f'{int_to_ip(v, n)}/{p}' 
+                                 for (v, n, p, c), e in zip(batch, expand)
+                                 if not e ]
+    countries = numpy.empty(len(batch), dtype=object)
+    countries[:] = [ c for v, n, p, c in batch ]
+
+    for item, country in zip(output.tolist(), countries[rows].tolist()):
+        yield { "item": item, "description": country }
 
-    logging.info('Processing subnets')
-    for subnet in subnets:
-        net = ipaddress.ip_network(subnet.get('cidr'))
-        country = subnet.get('country')
-        if net.version == 4:
-            if net.prefixlen >= 24:
-                # Use as is
-                items_described.append({ "item": net.compressed, 
-                                         "description": country })
-            else:
-                # Break in to /24s
-                new_subnets = list(net.subnets(new_prefix=24))
-                for net in new_subnets:
-                    items_described.append({ "item": net.compressed, 
-                                            "description": country })
-        else:
-            # Assume IPv6 and use as is
-            items_described.append({ "item": net.compressed, 
-                                     "description": country })
-    
-    return items_described
+    return
 
 
-def generate_custom_lists(b1tdc, base_name='', subnets=[], append=False):
+def generate_custom_lists(b1tdc, base_name='', subnets=[], append=False,
+                          engine='auto', sync=False, workers=1, rate=0,
+                          results=None, index=None, pack=False,
+                          by_country=False, journal=None, resume=False,
+                          retry=None, complete=True, per_country=False):
     '''
     Create BloxOne custom liss
 
@@ -340,63 +2906,232 @@ def generate_custom_lists(b1tdc, base_name='', subnets=[], append=False):
         base_name (str): base name of custom lists
         subnets (list): list of subnets
         append (bool): If list exists append data or not
+        engine (str): Engine used by process_subnets
+        sync (bool): Update existing lists with only the changes
+        workers (int): Number of lists to upload in parallel
+        rate (float): Maximum uploads started per second, 0 for no limit
+        results (list): Optional list populated with a dict per list
+                        {name, items, status, error, skipped}
+        index (obj): CustomListIndex, retrieved if not supplied
+        pack (bool): Aggregate subnets before splitting in to lists
+        by_country (bool): Keep each country's items together
+        journal (obj): Optional UploadJournal recording each upload
+        resume (bool): Skip lists already uploaded according to journal
+        retry (obj): Optional RetryPolicy for the API calls
+        complete (bool): False if retrieval failed for any country, 
+                         existing lists are then never synced or emptied
+        per_country (bool): Separate lists for each country
     
     Returns:
         custom_lists (list): List containing custom list names created
     '''
+    if not complete and (sync or resume):
+        # Missing countries would be removed from the lists
+        logging.error('Country data incomplete, custom lists not synced')
+        return []
+
     custom_lists = []
     failed_lists = []
     nets = []
-    no_of_lists = 1
+    chunks = []
     item_count = 0
-    max_items = 50000
+    if results is None:
+        results = []
+    if index is None:
+        try:
+            index = CustomListIndex(b1tdc, retry=retry)
+        except requests.exceptions.RequestException as err:
+            logging.error(f'Custom lists not created: {err}')
+            return custom_lists
+
+    if pack:
+        subnets = aggregate_subnets(subnets)
 
     # Process subnets and create format for items_described
-    nets = process_subnets(subnets)
+    # Chunking needs the item count so this is the one stage that 
+    # collects the full list
+    nets = list(process_subnets(subnets, engine=engine))
     item_count = len(nets)
-    # Check number of items (limit of 50000 per custom list)
-    if item_count > max_items:
-        no_of_lists = (item_count // max_items)
-        if (item_count % max_items) != 0:
-            no_of_lists += 1
-    else:
-        no_of_lists = 1
-    
-    logging.info(f'Creating {no_of_lists} custom lists - base name {base_name}')
-    if no_of_lists == 1:
-        if create_list(b1tdc, custom_list=base_name, item_list=nets):
-            custom_lists.append(base_name)
-        else:
-            logging.info(f'Failed to create custom list.')
-            failed_lists.append(base_name)
-    else:
-        offset = 0
-        items = max_items
-        for n in range(no_of_lists):
-            custom_list = f'{base_name}-{n}'
-            if (n + 1) == no_of_lists:
-                items = item_count % max_items
-            end = offset + items
-            items_list = nets[offset:end]
-            if create_list(b1tdc, 
-                           custom_list=custom_list, 
-                           item_list=items_list):
-                custom_lists.append(custom_list)
-            else:
-                failed_lists.append(custom_list)
+    chunks = plan_chunks(nets, base_name, by_country=by_country,
+                         per_country=per_country)
+    no_of_lists = len(chunks)
+
+    stale = []
+    if sync:
+        # Lists from a previous run that are no longer needed are emptied
+        stale = stale_lists(b1tdc, base_name, no_of_lists, index=index,
+                            retry=retry, 
+                            names=[ name for name, items in chunks ])
+        for custom_list in stale:
+            logging.info(f'Emptying unused custom list {custom_list}')
+            chunks.append((custom_list, []))
 
-            offset += max_items
+    logging.info(f'Creating {no_of_lists} custom lists - base name {base_name}')
+    results += upload_lists(b1tdc, chunks, sync=sync, workers=workers, 
+                            rate=rate, index=index, journal=journal,
+                            resume=resume, retry=retry)
+    for result in results:
+        if not result['status']:
+            failed_lists.append(result['name'])
+        elif result['name'] not in stale:
+            custom_lists.append(result['name'])
 
     # Log summary
     no_created = len(custom_lists)
     logging.info(f'Created {no_created} for {item_count} subnets.')
+    no_skipped = len([ r for r in results if r.get('skipped') ])
+    if no_skipped:
+        logging.info(f'Resumed {no_skipped} already uploaded.')
     if failed_lists:
-        logging.error(f'Failed to create {len(failed_lists)}')
+        logging.error(f'Failed to create {len(failed_lists)}: ' +
+                      f'{", ".join(failed_lists)}')
     
     return custom_lists
 
 
-def create_list(b1tdc, custom_list='', item_list=[]):
+def plan_chunks(nets, base_name, max_items=MAX_LIST_ITEMS, 
+                by_country=False, per_country=False):
+    '''
+    Split items in to the fewest custom lists of at most max_items.
+
+    With by_country each list only holds whole countries, other than
+    countries too large for one list which get full lists of their own,
+    {base_name}-{CC}-{n}. The rest are packed in ISO code order so the
+    plan is stable between runs, and each list is named after the 
+    first and last country in it, {base_name}-{CC} or 
+    {base_name}-{CC}-{CC}. With per_country every country gets lists 
+    of its own, {base_name}-{CC} or {base_name}-{CC}-{n}, so a change 
+    to one country only affects that country's lists at the cost of 
+    more lists.
+
+    Parameters:
+        nets (list): items_described structure
+        base_name (str): base name of custom lists
+        max_items (int): Maximum items per custom list
+        by_country (bool): Keep each country's items together
+        per_country (bool): Separate lists for each country
+
+    Returns:
+        chunks (list): (custom_list, item_list) tuples
+    '''
+    if by_country or per_country:
+        countries = {}
+        for net in nets:
+            country = net.get('description')
+            # Names only use ISO codes, XX is the user assigned code 
+            # commonly used for unknown
+            if not re.fullmatch('[A-Z]{2}', str(country)):
+                country = 'XX'
+            countries.setdefault(country, []).append(net)
+        chunks = []
+        packed = []
+        for country in sorted(countries):
+            items = countries[country]
+            if per_country and len(items) <= max_items:
+                chunks.append((f'{base_name}-{country}', items))
+            else:
+                # Full lists of their own for countries too large for one
+                full = len(items) - (len(items) % max_items)
+                if per_country:
+                    full = len(items)
+                chunks += [ (f'{base_name}-{country}-{n}', 
+                             items[offset:offset + max_items])
+                            for n, offset in 
+                            enumerate(range(0, full, max_items)) ]
+                remainder = items[full:]
+                if remainder:
+                    # Next fit in ISO code order
+                    if (not packed or 
+                        len(packed[-1][2]) + len(remainder) > max_items):
+                        packed.append([country, country, []])
+                    packed[-1][1] = country
+                    packed[-1][2].extend(remainder)
+        for first, last, items in packed:
+            name = f'{base_name}-{first}'
+            if last != first:
+                name += f'-{last}'
+            chunks.append((name, items))
+        if not chunks:
+            chunks = [ (base_name, []) ]
+    else:
+        bins = [ nets[offset:offset + max_items] 
+                 for offset in range(0, len(nets), max_items) ]
+        if len(bins) <= 1:
+            chunks = [ (base_name, bins[0] if bins else []) ]
+        else:
+            chunks = [ (f'{base_name}-{n}', items) 
+                       for n, items in enumerate(bins) ]
+
+    return chunks
+
+
+def upload_lists(b1tdc, chunks, sync=False, workers=1, rate=0, index=None,
+                 journal=None, resume=False, retry=None):
+    '''
+    Upload custom lists using a bounded pool of workers, starting at
+    most rate uploads per second
+
+    Parameters:
+        b1tdc (obj): bloxone.b1tdc object class
+        chunks (list): (custom_list, item_list) tuples
+        sync (bool): Update existing lists with only the changes
+        workers (int): Number of lists to upload in parallel
+        rate (float): Maximum uploads started per second, 0 for no limit
+        index (obj): Optional CustomListIndex used to check existence
+        journal (obj): Optional UploadJournal recording each upload
+        resume (bool): Skip lists the journal confirms were uploaded 
+                       with the same items, and sync the others
+        retry (obj): Optional RetryPolicy for the API calls
+
+    Returns:
+        results (list): dict per list {name, items, status, error,
+                        skipped} in the order of chunks
+    '''
+    limiter = RateLimiter(rate)
+    # A resumed list may exist from the interrupted run, so is synced
+    update_list = sync_list if sync or resume else create_list
+
+    def upload(chunk):
+        custom_list, item_list = chunk
+        errors = {}
+        digest = None
+        if journal:
+            digest = journal.digest(item_list)
+            if resume and journal.confirmed(custom_list, digest):
+                logging.info(f'Custom list {custom_list} already uploaded')
+                return { 'name': custom_list,
+                         'items': len(item_list),
+                         'status': True,
+                         'error': None,
+                         'skipped': True }
+        limiter.wait()
+        try:
+            status = update_list(b1tdc, custom_list=custom_list, 
+                                 item_list=item_list, errors=errors,
+                                 index=index, retry=retry)
+        except requests.exceptions.RequestException as err:
+            status = False
+            errors[custom_list] = str(err)
+        if journal:
+            journal.record(custom_list, digest, len(item_list), status)
+        return { 'name': custom_list,
+                 'items': len(item_list),
+                 'status': status,
+                 'error': errors.get(custom_list),
+                 'skipped': False }
+
+    if workers > 1 and len(chunks) > 1:
+        logging.debug(f'Uploading using {workers} workers')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(upload, chunks))
+    else:
+        results = [ upload(chunk) for chunk in chunks ]
+
+    return results
+
+
+def create_list(b1tdc, custom_list='', item_list=[], errors=None, index=None,
+                retry=None):
     '''
     Create custom list
 
@@ -404,33 +3139,173 @@ def create_list(b1tdc, custom_list='', item_list=[]):
         b1tdc (obj): bloxone.b1tdc object class
         custom_list (str): name of custom list
         item_list (list): items_described structure
+        errors (dict): Optional dict populated with {custom_list: error}
+        index (obj): Optional CustomListIndex used to check existence
+        retry (obj): Optional RetryPolicy for the API calls
     
     Returns:
         status (bool): True if successful
 
     '''
     status = False
-    id = b1tdc.get_custom_list(name=custom_list)
+    if retry is None:
+        retry = RetryPolicy(attempts=1)
+    if index:
+        id = index.get(custom_list)
+    else:
+        id = retry.call(b1tdc.get_custom_list, name=custom_list)
     if not id:
         logging.info(f'Creating custom list {custom_list} for {len(item_list)} items.')
-        response = b1tdc.create_custom_list(name=custom_list, 
-                                            items_described=item_list)
+        response = retry.call(b1tdc.create_custom_list, name=custom_list, 
+                              items_described=item_list)
         if response.status_code in b1tdc.return_codes_ok:
             logging.info(f'Successfully created custom list: {custom_list}')
             status = True
+            if index:
+                index.add(custom_list, 
+                          response.json().get('results', {}).get('id'))
         else:
             logging.error(f'Failed to create custom list: {custom_list}')
             logging.error(f'HTTP Response Code: {response.status_code}')
             logging.error(f'Content: {response.text}')
             status = False
+            if errors is not None:
+                errors[custom_list] = (f'API error: {response.status_code} - ' +
+                                       f'{response.text}')
     else:
         logging.warning(f'Custom list {custom_list} exists')
         status = False
+        if errors is not None:
+            errors[custom_list] = 'Custom list exists'
+
+    return status
+
+
+def sync_list(b1tdc, custom_list='', item_list=[], errors=None, index=None,
+              retry=None):
+    '''
+    Synchronise custom list with item_list, sending only the items 
+    added or removed. The list is created if it does not exist.
+
+    Parameters:
+        b1tdc (obj): bloxone.b1tdc object class
+        custom_list (str): name of custom list
+        item_list (list): items_described structure
+        errors (dict): Optional dict populated with {custom_list: error}
+        index (obj): Optional CustomListIndex used to find the list
+        retry (obj): Optional RetryPolicy for the API calls
+
+    Returns:
+        status (bool): True if successful
+    '''
+    status = False
+    if retry is None:
+        retry = RetryPolicy(attempts=1)
+    if index:
+        list_id = index.get(custom_list)
+        if list_id:
+            response = retry.call(b1tdc.get, '/named_lists', id=list_id)
+        else:
+            response = None
+    else:
+        response = retry.call(b1tdc.get_custom_list, name=custom_list)
+    if not response:
+        return create_list(b1tdc, custom_list=custom_list, 
+                           item_list=item_list, errors=errors, index=index,
+                           retry=retry)
+
+    current = response.json().get('results', {})
+    list_id = current.get('id')
+    existing = { i.get('item'): i.get('description') 
+                 for i in current.get('items_described', []) }
+    wanted = { i.get('item'): i.get('description') for i in item_list }
+    # Items with a changed description are removed and added again
+    removed = [ item for item, description in existing.items()
+                if wanted.get(item, description) != description or
+                item not in wanted ]
+    added = [ i for i in item_list 
+              if existing.get(i.get('item'), object()) != i.get('description') ]
+    logging.info(f'Syncing custom list {custom_list}: {len(added)} added, ' +
+                 f'{len(removed)} removed')
+
+    status = True
+    # Remove first so the list never exceeds its item limit
+    if removed:
+        response = retry.call(b1tdc.delete, f'/named_lists/{list_id}/items',
+                              body=json.dumps({ "items": removed }))
+        if response.status_code not in b1tdc.return_codes_ok:
+            logging.error(f'Failed to remove items from: {custom_list}')
+            logging.error(f'HTTP Response Code: {response.status_code}')
+            logging.error(f'Content: {response.text}')
+            status = False
+            if errors is not None:
+                errors[custom_list] = (f'API error: {response.status_code} - ' +
+                                       f'{response.text}')
+    if added and status:
+        response = retry.call(b1tdc.post, f'/named_lists/{list_id}/items',
+                              body=json.dumps({ "items_described": added }))
+        if response.status_code not in b1tdc.return_codes_ok:
+            logging.error(f'Failed to add items to: {custom_list}')
+            logging.error(f'HTTP Response Code: {response.status_code}')
+            logging.error(f'Content: {response.text}')
+            status = False
+            if errors is not None:
+                errors[custom_list] = (f'API error: {response.status_code} - ' +
+                                       f'{response.text}')
+    if status:
+        logging.info(f'Successfully synced custom list: {custom_list}')
 
     return status
 
 
-def apply_custom_list(b1tdc, policy='', custom_lists=[]):
+def stale_lists(b1tdc, base_name, no_of_lists, index=None, retry=None,
+                names=None):
+    '''
+    Find custom lists for base_name left over from a previous run that
+    needed a different number of lists
+
+    Parameters:
+        b1tdc (obj): bloxone.b1tdc object class
+        base_name (str): base name of custom lists
+        no_of_lists (int): Number of lists in use
+        index (obj): Optional CustomListIndex used to check existence
+        retry (obj): Optional RetryPolicy for the API calls
+        names (list): Optional names of the lists in use, with an index
+                      any numbered or per country list for base_name
+                      not in names is stale
+
+    Returns:
+        list of custom list names
+    '''
+    if retry is None:
+        retry = RetryPolicy(attempts=1)
+    if index:
+        exists = index.get
+    else:
+        exists = lambda name: retry.call(b1tdc.get_custom_list, name=name)
+    stale = []
+    if index and names is not None:
+        # {base}, {base}-{n}, {base}-{CC}, {base}-{CC}-{CC} and 
+        # {base}-{CC}-{n}
+        pattern = re.compile(re.escape(base_name) + 
+                             r'(-\d+|-[A-Z]{2}(-[A-Z]{2}|-\d+)?)?')
+        stale = sorted(name for name in index.names() 
+                       if pattern.fullmatch(name) and name not in names)
+    else:
+        if no_of_lists > 1:
+            if exists(base_name):
+                stale.append(base_name)
+            n = no_of_lists
+        else:
+            n = 0
+        while exists(f'{base_name}-{n}'):
+            stale.append(f'{base_name}-{n}')
+            n += 1
+
+    return stale
+
+
+def apply_custom_list(b1tdc, policy='', custom_lists=[], retry=None):
     '''
     Add custom list to security policy
 
@@ -438,35 +3313,59 @@ def apply_custom_list(b1tdc, policy='', custom_lists=[]):
         b1tdc (obj): bloxone.b1tdc object class
         policy (str): Name of security policy
         custom_list (str): Name of custom list
+        retry (obj): Optional RetryPolicy for the API calls
     
     Returns:
         Bool: True if successful
     '''
     status = False
-    policy_id = b1tdc.get_id('/security_policies', key='name', value=policy)
+    if retry is None:
+        retry = RetryPolicy(attempts=1)
+    # Look up the id directly as get_id() hides the status code
+    response = retry.call(b1tdc.get, '/security_policies', _fields='name,id')
+    if response.status_code not in b1tdc.return_codes_ok:
+        logging.error('Failed to retrieve security policies')
+        logging.error(f'HTTP Response Code: {response.status_code}')
+        logging.error(f'Content: {response.text}')
+        return False
+    policy_id = next((p.get('id') for p in response.json().get('results', [])
+                      if p.get('name') == policy), None)
     if policy_id:
         logging.info(f'Retrieving security policy: {policy}')
-        response = b1tdc.get('/security_policies', id=policy_id)
+        response = retry.call(b1tdc.get, '/security_policies', id=policy_id)
         if response.status_code in b1tdc.return_codes_ok:
             policy_data = response.json()['results']
-            # Build rules for custom lists
+            # Build rules for custom lists, a resumed run may find 
+            # some already applied
+            applied = [ rule.get('data') for rule in policy_data['rules']
+                        if rule.get('type') == 'custom_list' ]
+            added = 0
             for custom_list in custom_lists:
+                if custom_list in applied:
+                    continue
                 policy_data['rules'].append({ "action": "action_block",
                                             "data": custom_list,
                                             "type": "custom_list" })
-            # Update security policy
-            logging.info(f'Updating policy: {policy} with id {policy_id}')
-            response = b1tdc.put('/security_policies', 
-                                 id=policy_id,
-                                 body=json.dumps(policy_data))
-            if response.status_code in b1tdc.return_codes_ok:
-                logging.info(f'Successfully updated security policy: {policy}')
+                added += 1
+            if not added:
+                logging.info(f'Security policy {policy} already includes ' +
+                             'custom lists')
                 status = True
             else:
-                logging.error(f'Failed to update security policy: {policy}')
-                logging.error(f'HTTP Response Code: {response.status_code}')
-                logging.error(f'Content: {response.text}')
-                status = False
+                # Update security policy
+                logging.info(f'Updating policy: {policy} with id {policy_id}')
+                response = retry.call(b1tdc.put, '/security_policies', 
+                                      id=policy_id,
+                                      body=json.dumps(policy_data))
+                if response.status_code in b1tdc.return_codes_ok:
+                    logging.info('Successfully updated security policy: ' +
+                                 f'{policy}')
+                    status = True
+                else:
+                    logging.error(f'Failed to update security policy: {policy}')
+                    logging.error(f'HTTP Response Code: {response.status_code}')
+                    logging.error(f'Content: {response.text}')
+                    status = False
         else:
             logging.error(f'Failed to retrieve security policy: {policy}')
             logging.error(f'HTTP Response Code: {response.status_code}')
@@ -479,6 +3378,389 @@ def apply_custom_list(b1tdc, policy='', custom_lists=[]):
     return status
 
 
+def service_handler(service, zone='countryips.rpz.local', view='default'):
+    '''
+    Build the HTTP request handler for a CountryService
+
+    Endpoints:
+        GET /lookup?ip=<address>[&ip=...]
+        POST /lookup with a JSON list of addresses, or {"ips": [...]}
+        GET /export/csv[?country=<iso>,...]
+        GET /export/nios[?country=<iso>,...]
+        GET /status
+
+    Parameters:
+        service (obj): CountryService instance
+        zone (str): rpz zone name for NIOS exports
+        view (str): DNS view for NIOS exports
+
+    Returns:
+        http.server.BaseHTTPRequestHandler subclass
+    '''
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        server_version = f'b1td_country_ip/{__version__}'
+
+        def log_message(self, format, *args):
+            log.debug(f'{self.address_string()} {format % args}')
+
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+        def send_lookup(self, addresses):
+            _, index = service.snapshot()
+            results = [ { 'ip': address, 'country': country } 
+                        for address, country 
+                        in zip(addresses, index.lookup_many(addresses)) ]
+            self.send_json({ 'results': results })
+
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            if url.path == '/lookup':
+                addresses = query.get('ip')
+                if not addresses:
+                    self.send_json({ 'error': 'ip parameter required' }, 400)
+                else:
+                    self.send_lookup(addresses)
+            elif url.path in ('/export/csv', '/export/nios'):
+                subnets, _ = service.snapshot()
+                if query.get('country'):
+                    selected = { c.upper() for value in query['country']
+                                 for c in value.split(',') }
+                    subnets = ( s for s in subnets 
+                                if s.get('country') in selected )
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/csv')
+                # Streamed without a length, the connection is closed
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                self.close_connection = True
+                outfile = codecs.getwriter('utf-8')(self.wfile)
+                if url.path == '/export/csv':
+                    output_csv(subnets, outfile=outfile)
+                else:
+                    output_nios_csv(subnets, zone=zone, view=view, 
+                                    outfile=outfile)
+            elif url.path == '/status':
+                self.send_json(service.status())
+            else:
+                self.send_json({ 'error': 'not found' }, 404)
+
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path != '/lookup':
+                self.send_json({ 'error': 'not found' }, 404)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                data = json.loads(self.rfile.read(length) or b'[]')
+                if isinstance(data, dict):
+                    data = data.get('ips', [])
+                if not isinstance(data, list):
+                    raise ValueError('expected a list of addresses')
+            except ValueError as err:
+                self.send_json({ 'error': f'Invalid request: {err}' }, 400)
+                return
+            self.send_lookup([ str(address) for address in data ])
+
+    return Handler
+
+
+def serve(service, host='127.0.0.1', port=8080, 
+          interval=DEFAULT_SERVE_INTERVAL):
+    '''
+    Serve lookups and exports over HTTP, refreshing the dataset every
+    interval seconds in a background thread, until interrupted
+
+    Parameters:
+        service (obj): CountryService with a dataset loaded
+        host (str): IPv4 or IPv6 address to listen on
+        port (int): Port to listen on
+        interval (int): Seconds between refreshes, 0 for none
+    '''
+    stop = threading.Event()
+
+    def refresh():
+        while not stop.wait(interval):
+            try:
+                service.refresh()
+            except Exception as err:
+                log.error(f'Refresh failed: {err}')
+
+    class Server(http.server.ThreadingHTTPServer):
+        # The base class only binds IPv4 addresses
+        address_family = socket.AF_INET6 if ':' in host else socket.AF_INET
+
+    server = Server((host, port), service_handler(service))
+    server.daemon_threads = True
+    if interval:
+        threading.Thread(target=refresh, daemon=True).start()
+    address = f'[{host}]' if ':' in host else host
+    log.info(f'Serving on {address}:{server.server_address[1]}, ' +
+             f'refreshing every {interval}s')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('Stopping')
+    finally:
+        stop.set()
+        server.server_close()
+
+    return
+
+
+def write_outputs(args, subnets, errors=None, retry=None, resume=False,
+                  sync=False):
+    '''
+    Generate every output requested by args from a single pass over 
+    subnets. Output files are only replaced if there are no errors.
+
+    Parameters:
+        args (obj): Parsed arguments
+        subnets (iterable): dict {cidr, country}
+        errors (dict): Errors from retrieval, populated as subnets are
+                       consumed
+        retry (obj): Optional RetryPolicy for the API calls
+        resume (bool): Skip custom lists already uploaded with the same
+                       items, in addition to --resume
+        sync (bool): Sync custom lists, in addition to --sync
+
+    Returns:
+        exitcode (int)
+    '''
+    exitcode = 0
+    outputfile = args.output
+    custom_list = args.custom_list
+    policy = args.policy
+    if errors is None:
+        errors = {}
+
+    if args.enrich:
+        try:
+            infile = open_input(args.enrich)
+        except (IOError, ValueError) as err:
+            log.error(f'Failed to open {args.enrich}: {err}')
+            return 1
+
+    # Set up output files, each format may have its own
+    outputs = {}
+    if args.subnets is not None:
+        outputs['csv'] = args.subnets or outputfile
+    if args.nios is not None:
+        outputs['nios'] = args.nios or outputfile
+    if args.enrich:
+        outputs['enrich'] = outputfile
+    if args.db:
+        outputs['db'] = args.db
+    outfiles = {}
+    for output, filename in outputs.items():
+        outfile = None
+        if filename and output == 'db':
+            # Memory mapped so never compressed
+            outfile = open_file(filename, compress='none', keep=args.keep,
+                                binary=True)
+        elif filename:
+            outfile = open_file(filename, compress=args.compress, 
+                                keep=args.keep)
+        if filename and not outfile:
+            log.error(f'Failed to open output file {filename}.')
+            for opened in outfiles.values():
+                if opened:
+                    opened.abort()
+            return 1
+        outfiles[output] = outfile
+
+    if args.aggregate:
+        subnets = aggregate_subnets(subnets, 
+                                    across_countries=(args.aggregate == 'all'))
+
+    # Single pass over the subnets feeding every requested output
+    writers = []
+    if 'csv' in outfiles:
+        writers.append(csv_writer(outfiles['csv']))
+    if 'nios' in outfiles:
+        writers.append(nios_writer(outfiles['nios']))
+    consumers = list(writers)
+    if custom_list or args.lookup or args.enrich or args.db:
+        # Custom lists and the lookup index need the complete set
+        collected = []
+        consumers.append(collected.append)
+
+    try:
+        fan_out(subnets, consumers)
+        for writer in writers:
+            writer.flush()
+        if args.lookup or args.enrich or args.db:
+            index = CountryLookup(collected, engine=args.engine)
+        if args.db:
+            write_country_db(index, outfiles['db'])
+        if args.enrich:
+            try:
+                enrich_file(index, infile, outfiles['enrich'],
+                            column=args.column, 
+                            delimiter=args.delimiter,
+                            header=args.header,
+                            processes=args.processes)
+            except (IOError, ValueError) as err:
+                log.error(f'Failed to enrich {args.enrich}: {err}')
+                errors[args.enrich] = str(err)
+            finally:
+                if infile is not sys.stdin:
+                    infile.close()
+        if args.lookup:
+            addresses = [ a.strip() for a in args.lookup.split(',') ]
+            for address, country in zip(addresses, 
+                                        index.lookup_many(addresses)):
+                print(f'{address},{country or ""}')
+        if custom_list:
+            b1tdc = bloxone.b1tdc(args.config)
+            journal = UploadJournal(args.journal or 
+                                    os.path.join(args.cache_dir, 
+                                                 f'{custom_list}.journal'),
+                                    base_name=custom_list,
+                                    resume=args.resume or resume)
+            custom_lists = generate_custom_lists(b1tdc, 
+                                                 base_name=custom_list,
+                                                 subnets=collected,
+                                                 engine=args.engine,
+                                                 sync=args.sync or sync,
+                                                 workers=args.upload_workers,
+                                                 rate=args.rate,
+                                                 pack=args.pack,
+                                                 by_country=args.by_country,
+                                                 per_country=args.per_country,
+                                                 journal=journal,
+                                                 resume=args.resume or resume,
+                                                 retry=retry,
+                                                 complete=not errors)
+            if custom_lists:
+                if policy:
+                    apply_custom_list(b1tdc, policy, custom_lists, 
+                                      retry=retry)
+            else:
+                exitcode = 1
+        if errors:
+            exitcode = 1
+
+        for outfile in outfiles.values():
+            if outfile:
+                if errors:
+                    log.error('Output incomplete, existing output file ' +
+                              'retained')
+                    outfile.abort()
+                    exitcode = 1
+                else:
+                    outfile.close()
+    except BaseException:
+        # Never leave a partial output file in place, including those
+        # not yet committed when a close fails
+        for outfile in outfiles.values():
+            if outfile:
+                outfile.abort()
+        raise
+
+    return exitcode
+
+
+def country_digests(subnets):
+    '''
+    Hash the set of CIDRs of each country, independent of order
+
+    Parameters:
+        subnets (iterable): dict {cidr, country}
+
+    Returns:
+        dict { country: sha256 hex digest }
+    '''
+    cidrs = {}
+    for subnet in subnets:
+        cidrs.setdefault(subnet.get('country'), set()).add(subnet.get('cidr'))
+
+    return { country: hashlib.sha256(
+                 '\n'.join(sorted(values)).encode()).hexdigest()
+             for country, values in cidrs.items() }
+
+
+def watch(args, b1td, countries, cache=None, retry=None):
+    '''
+    Retrieve countries every args.watch seconds, regenerating outputs
+    only when a country's set of CIDRs has changed. Custom lists are
+    always synced, so lists left by an earlier run are updated rather
+    than failing as existing. After the first pass lists whose items 
+    are unchanged, according to the upload journal, are skipped, so 
+    only the lists holding changed countries are updated. Runs until 
+    interrupted.
+
+    Parameters:
+        args (obj): Parsed arguments
+        b1td (obj): bloxone.b1td instance
+        countries (list): list of countries
+        cache (obj): Optional CountryCache instance
+        retry (obj): Optional RetryPolicy for the API calls
+
+    Returns:
+        exitcode (int) of the last pass that changed outputs
+    '''
+    exitcode = 0
+    previous = {}
+    first = True
+    if cache:
+        # Revalidate every pass, unchanged countries cost a 304. The
+        # countries table keeps the normal TTL.
+        cache.table_ttl = cache.ttl
+        cache.ttl = 0
+    log.info(f'Watching for changes every {args.watch}s')
+    try:
+        while True:
+            started = time.monotonic()
+            errors = {}
+            if args.use_async:
+                subnets = asyncio.run(get_subnets_async(b1td, countries,
+                                          concurrency=args.workers,
+                                          errors=errors, cache=cache,
+                                          retry=retry))
+            else:
+                subnets = get_subnets(b1td, countries, workers=args.workers,
+                                      errors=errors, cache=cache, 
+                                      retry=retry)
+            if errors:
+                log.error('Retrieval incomplete, outputs not updated')
+            else:
+                digests = country_digests(subnets)
+                changed = sorted((c for c in digests.keys() | previous.keys()
+                                  if digests.get(c) != previous.get(c)),
+                                 key=str)
+                if changed:
+                    log.info(f'{len(changed)} countries changed: ' +
+                             f'{", ".join(map(str, changed))}')
+                    exitcode = write_outputs(args, subnets, errors=errors,
+                                             retry=retry, resume=not first,
+                                             sync=True)
+                    if exitcode == 0:
+                        previous = digests
+                        first = False
+                else:
+                    log.info('No changes')
+            if retry and retry.summary():
+                log.info(retry.summary())
+            del subnets
+            time.sleep(max(args.watch - (time.monotonic() - started), 0))
+    except KeyboardInterrupt:
+        log.info('Stopping')
+
+    return exitcode
+
+
 def main():
     '''
     * Main *
@@ -495,42 +3777,65 @@ def main():
     debug = args.debug
     configfile = args.config
     setup_logging(debug)
-    outputfile = args.output
     countries = parse_countries(args.countries)
-    csv = args.subnets
-    nios = args.nios
-    custom_list = args.custom_list
-    policy = args.policy
+    if not countries:
+        log.info('No countries specified, using complete dataset')
+        countries = ['']
+    workers = args.workers
+    use_async = args.use_async
     # append = args.append
 
     # Initialise bloxone
     b1td = bloxone.b1td(configfile)
+    retry = RetryPolicy(attempts=args.retries, max_backoff=args.max_backoff,
+                        timeout=args.timeout)
 
-    # Set up output file
-    if outputfile:
-        outfile = open_file(outputfile)
-        if not outfile:
-            log.error('Failed to open output file for CSV.')
+    # Set up country data cache
+    if args.no_cache:
+        cache = None
     else:
-        outfile = False
-
-    subnets = get_subnets(b1td, countries)
-
-    # Parse args ensures one of these is set
-    if csv:
-        output_csv(subnets, outfile=outfile)
-    if nios:
-        output_nios_csv(subnets, outfile=outfile)
-    if custom_list:
-        b1tdc = bloxone.b1tdc(configfile)
-        custom_lists = generate_custom_lists(b1tdc, 
-                                            base_name=custom_list,
-                                            subnets = subnets)
-        if custom_lists:
-            if policy:
-                apply_custom_list(b1tdc, policy, custom_lists)
-        else:
-            exitcode = 1
+        cache = CountryCache(cache_dir=args.cache_dir, 
+                             ttl=args.cache_ttl,
+                             refresh=args.refresh)
+
+    if args.serve:
+        host, _, port = args.serve.rpartition(':')
+        # Local only unless an address is given
+        host = host.strip('[]') or '127.0.0.1'
+        if cache:
+            # Revalidate on every refresh, unchanged countries cost a 
+            # 304. The countries table keeps the normal TTL.
+            cache.table_ttl = cache.ttl
+            cache.ttl = 0
+        service = CountryService(b1td, countries, cache=cache, 
+                                 workers=workers, retry=retry,
+                                 aggregate=args.aggregate, 
+                                 engine=args.engine)
+        if not service.refresh():
+            return 1
+        serve(service, host=host, port=int(port), 
+              interval=args.serve_interval)
+        return 0
+
+    if args.watch:
+        return watch(args, b1td, countries, cache=cache, retry=retry)
+
+    errors = {}
+    if use_async:
+        subnets = asyncio.run(get_subnets_async(b1td, countries, 
+                                                concurrency=workers,
+                                                errors=errors,
+                                                cache=cache,
+                                                retry=retry))
+    else:
+        # Stream records to the output as they are received
+        subnets = iter_subnets(b1td, countries, errors=errors, cache=cache, 
+                               workers=workers, retry=retry)
+
+    exitcode = write_outputs(args, subnets, errors=errors, retry=retry)
+
+    if retry.summary():
+        log.info(retry.summary())
 
     return exitcode
 
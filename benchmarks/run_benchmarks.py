@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+------------------------------------------------------------------------
+
+ Description:
+  Benchmark the processing and output stages of 
+  b1td_country_ip_blocking.py against synthetic country_ip datasets.
+
+  Each stage is run once for wall clock time and once under tracemalloc
+  for peak memory. Custom list creation runs against a local fake 
+  b1tdc so no API calls are made. Results are written as JSON so runs
+  can be compared between versions.
+
+ Usage:
+    run_benchmarks.py --sizes small,us -o results.json
+    run_benchmarks.py --sizes world --benchmarks output_csv,output_nios_csv
+
+------------------------------------------------------------------------
+"""
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                '..'))
+import b1td_country_ip_blocking as b1country
+import synthetic
+
+
+class FakeResponse:
+    '''
+    Minimal requests.Response stand in
+    '''
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.text = json.dumps(body or {})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeB1TDC:
+    '''
+    Local stand in for bloxone.b1tdc that accepts custom lists 
+    without making API calls
+    '''
+    return_codes_ok = [200, 201, 204]
+
+    def __init__(self):
+        self.lists = {}
+
+    def get_custom_lists(self, **params):
+        return FakeResponse(200, { 'results': list(self.lists.values()) })
+
+    def get_custom_list(self, name='', **params):
+        if name in self.lists:
+            return FakeResponse(200, { 'results': self.lists[name] })
+        return False
+
+    def create_custom_list(self, name='', items_described=[], **params):
+        self.lists[name] = { 'name': name, 
+                             'id': len(self.lists) + 1,
+                             'item_count': len(items_described) }
+        return FakeResponse(201, { 'results': self.lists[name] })
+
+
+def bench_process_subnets(subnets, engine='auto'):
+    for _ in b1country.process_subnets(subnets, engine=engine):
+        pass
+
+
+def bench_output_csv(subnets):
+    with open(os.devnull, 'w') as outfile:
+        b1country.output_csv(subnets, outfile=outfile)
+
+
+def bench_output_nios_csv(subnets):
+    with open(os.devnull, 'w') as outfile:
+        b1country.output_nios_csv(subnets, outfile=outfile)
+
+
+def bench_generate_custom_lists(subnets):
+    b1country.generate_custom_lists(FakeB1TDC(), base_name='bench',
+                                    subnets=subnets)
+
+
+def bench_aggregate_subnets(subnets):
+    for _ in b1country.aggregate_subnets(subnets):
+        pass
+
+
+def bench_lookup(subnets):
+    index = b1country.CountryLookup(subnets)
+    # First address of every subnet, a hit for each lookup
+    addresses = [ subnet['cidr'].partition('/')[0] for subnet in subnets ]
+    index.lookup_many(addresses)
+
+
+def bench_parse(body):
+    for _ in b1country.iter_country_ips(
+            body[i:i + b1country.CHUNK_SIZE] 
+            for i in range(0, len(body), b1country.CHUNK_SIZE)):
+        pass
+
+
+BENCHMARKS = {
+    'parse': bench_parse,
+    'process_subnets': bench_process_subnets,
+    'process_subnets_python': 
+        lambda subnets: bench_process_subnets(subnets, engine='python'),
+    'aggregate_subnets': bench_aggregate_subnets,
+    'output_csv': bench_output_csv,
+    'output_nios_csv': bench_output_nios_csv,
+    'generate_custom_lists': bench_generate_custom_lists,
+    'lookup': bench_lookup,
+}
+
+
+def measure(func, data):
+    '''
+    Time func(data) and measure its peak memory
+
+    Parameters:
+        func (callable): Benchmark function
+        data (obj): Argument for func
+
+    Returns:
+        dict { seconds, peak_bytes }
+    '''
+    gc.collect()
+    start = time.perf_counter()
+    func(data)
+    seconds = time.perf_counter() - start
+
+    # Separate run so tracing overhead does not affect timing
+    gc.collect()
+    tracemalloc.start()
+    func(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return { 'seconds': round(seconds, 4), 'peak_bytes': peak }
+
+
+def run(sizes, benchmarks, seed=1):
+    '''
+    Run benchmarks against each dataset size
+
+    Parameters:
+        sizes (list): Dataset sizes from synthetic.SIZES
+        benchmarks (list): Names from BENCHMARKS
+        seed (int): Random seed for datasets
+
+    Returns:
+        dict of results
+    '''
+    results = { 'version': b1country.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'numpy': bool(b1country.numpy),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', 
+                                           time.gmtime()),
+                'datasets': {} }
+    if b1country.numpy:
+        # Build lookup tables up front so they are not counted once
+        b1country.octet_tables()
+
+    for size in sizes:
+        payload = synthetic.generate(size, seed=seed)
+        subnets = payload['country_ip']
+        body = json.dumps(payload).encode()
+        dataset = { 'records': len(subnets), 
+                    'body_bytes': len(body),
+                    'results': {} }
+        for name in benchmarks:
+            print(f'{size}: {name}', file=sys.stderr)
+            data = body if name == 'parse' else subnets
+            dataset['results'][name] = measure(BENCHMARKS[name], data)
+        results['datasets'][size] = dataset
+
+    return results
+
+
+def main():
+    '''
+    Run benchmarks and output JSON results
+    '''
+    parse = argparse.ArgumentParser(description='Benchmark country IP stages')
+    parse.add_argument('--sizes', type=str, default='small,us',
+                       help="Comma separated dataset sizes: " +
+                            ','.join(synthetic.SIZES))
+    parse.add_argument('--benchmarks', type=str, 
+                       default=','.join(BENCHMARKS),
+                       help="Comma separated benchmarks to run")
+    parse.add_argument('--seed', type=int, default=1, help="Random seed")
+    parse.add_argument('-o', '--output', type=str, default='',
+                       help="Output JSON to <filename>")
+    args = parse.parse_args()
+
+    # Keep benchmark output readable
+    b1country.logging.basicConfig(level=b1country.logging.WARNING)
+    results = run(args.sizes.split(','), args.benchmarks.split(','), 
+                  seed=args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    return
+
+
+if __name__ == '__main__':
+    main()
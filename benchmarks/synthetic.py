@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+------------------------------------------------------------------------
+
+ Description:
+  Generate synthetic TIDE country_ip payloads for benchmarking.
+
+  Datasets follow the shape of the real data: mostly /24 and smaller
+  IPv4 subnets with a tail of larger allocations, plus IPv6 prefixes.
+
+ Usage:
+    synthetic.py --size us -o us.json
+
+------------------------------------------------------------------------
+"""
+import argparse
+import ipaddress
+import json
+import random
+
+# Named sizes: (number of countries, total prefixes)
+SIZES = {
+    'small': (1, 2000),
+    'us': (1, 60000),
+    'world': (240, 500000),
+}
+
+# IPv4 prefix length distribution (prefixlen, weight)
+IPV4_PREFIXES = [ (8, 1), (10, 2), (12, 5), (14, 15), (16, 60), 
+                  (18, 60), (19, 80), (20, 150), (21, 160), (22, 350), 
+                  (23, 300), (24, 1500), (25, 40), (26, 40), (27, 30), 
+                  (28, 30), (29, 30), (30, 10), (32, 20) ]
+IPV6_PREFIXES = [ (29, 20), (32, 150), (36, 20), (40, 30), (44, 40), 
+                  (48, 300), (56, 20), (64, 20) ]
+IPV6_RATIO = 0.2
+
+
+def country_codes(count):
+    '''
+    Generate count two letter country codes
+
+    Parameters:
+        count (int): Number of codes
+
+    Returns:
+        list of str
+    '''
+    codes = []
+    for a in range(26):
+        for b in range(26):
+            codes.append(chr(65 + a) + chr(65 + b))
+
+    return codes[:count]
+
+
+def random_network(rnd, version):
+    '''
+    Generate a random aligned network
+
+    Parameters:
+        rnd (obj): random.Random instance
+        version (int): 4 or 6
+
+    Returns:
+        cidr (str)
+    '''
+    if version == 4:
+        prefixes, weights = zip(*IPV4_PREFIXES)
+        prefixlen = rnd.choices(prefixes, weights)[0]
+        # Stay within public unicast space 1.0.0.0 - 223.255.255.255
+        address = rnd.randrange(1 << 24, 224 << 24)
+        address &= (0xffffffff << (32 - prefixlen)) & 0xffffffff
+        return (f'{address >> 24}.{address >> 16 & 255}.' +
+                f'{address >> 8 & 255}.{address & 255}/{prefixlen}')
+    else:
+        prefixes, weights = zip(*IPV6_PREFIXES)
+        prefixlen = rnd.choices(prefixes, weights)[0]
+        # Global unicast 2000::/3
+        address = (1 << 125) | rnd.getrandbits(125)
+        address &= ((1 << 128) - 1) ^ ((1 << (128 - prefixlen)) - 1)
+        return f'{ipaddress.IPv6Address(address).compressed}/{prefixlen}'
+
+
+def generate(size='small', seed=1):
+    '''
+    Generate a synthetic country_ip payload
+
+    Parameters:
+        size (str): small, us or world
+        seed (int): Random seed so datasets are reproducible
+
+    Returns:
+        dict { "country_ip": [ {cidr, country} ] }
+    '''
+    rnd = random.Random(seed)
+    no_of_countries, total = SIZES[size]
+    codes = country_codes(no_of_countries)
+    # Country sizes roughly follow a power law
+    weights = [ 1 / (rank + 1) for rank in range(no_of_countries) ]
+    scale = total / sum(weights)
+
+    records = []
+    for code, weight in zip(codes, weights):
+        for _ in range(max(int(weight * scale), 1)):
+            version = 6 if rnd.random() < IPV6_RATIO else 4
+            records.append({ 'cidr': random_network(rnd, version), 
+                             'country': code })
+
+    return { 'country_ip': records }
+
+
+def main():
+    '''
+    Write a synthetic payload to file
+    '''
+    parse = argparse.ArgumentParser(description='Synthetic country_ip data')
+    parse.add_argument('-s', '--size', choices=SIZES.keys(), default='small',
+                       help="Dataset size")
+    parse.add_argument('--seed', type=int, default=1, help="Random seed")
+    parse.add_argument('-o', '--output', type=str, required=True,
+                       help="Output to <filename>")
+    args = parse.parse_args()
+
+    with open(args.output, 'w') as f:
+        json.dump(generate(args.size, seed=args.seed), f)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+------------------------------------------------------------------------
+
+ Description:
+  Tests for custom list synchronisation and chunk planning against a
+  local fake b1tdc, so no API calls are made.
+
+ Usage:
+    python -m pytest tests
+
+------------------------------------------------------------------------
+"""
+import os
+import sys
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import b1td_country_ip_blocking as b1country
+
+
+class FakeResponse:
+    '''
+    Minimal requests.Response stand in
+    '''
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.text = json.dumps(body or {})
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeB1TDC:
+    '''
+    Local stand in for bloxone.b1tdc holding custom lists in memory and
+    recording item changes
+    '''
+    return_codes_ok = [200, 201, 204]
+
+    def __init__(self):
+        self.lists = {}
+        self.calls = []
+        self.fail = set()
+
+    def named_list(self, path):
+        list_id = int(path.split('/')[2])
+        return next(l for l in self.lists.values() if l['id'] == list_id)
+
+    def get_custom_lists(self, _offset='0', **params):
+        results = [ { 'name': l['name'], 'id': l['id'] }
+                    for l in self.lists.values() ]
+        return FakeResponse(200, { 'results': results[int(_offset):] })
+
+    def get_custom_list(self, name='', **params):
+        if name in self.lists:
+            return FakeResponse(200, { 'results': self.lists[name] })
+        return FakeResponse(404)
+
+    def get(self, path, id='', **params):
+        custom_list = self.named_list(f'/named_lists/{id}')
+        return FakeResponse(200, { 'results': custom_list })
+
+    def create_custom_list(self, name='', items_described=[], **params):
+        self.calls.append(('create', name, len(items_described)))
+        self.lists[name] = { 'name': name, 'id': len(self.lists) + 1,
+                             'items_described': list(items_described) }
+        return FakeResponse(201, { 'results': self.lists[name] })
+
+    def delete(self, path, body='', **params):
+        if 'delete' in self.fail:
+            return FakeResponse(500)
+        items = json.loads(body)['items']
+        self.calls.append(('delete', sorted(items)))
+        custom_list = self.named_list(path)
+        custom_list['items_described'] = [
+            i for i in custom_list['items_described']
+            if i['item'] not in items ]
+        return FakeResponse(200)
+
+    def post(self, path, body='', **params):
+        items = json.loads(body)['items_described']
+        self.calls.append(('post', sorted(i['item'] for i in items)))
+        self.named_list(path)['items_described'] += items
+        return FakeResponse(201)
+
+
+def items(*pairs):
+    return [ { 'item': item, 'description': country }
+             for item, country in pairs ]
+
+
+def contents(b1tdc, name):
+    return sorted((i['item'], i['description'])
+                  for i in b1tdc.lists[name]['items_described'])
+
+
+def test_sync_creates_missing_list():
+    b1tdc = FakeB1TDC()
+    wanted = items(('1.2.3.0/24', 'AA'))
+    assert b1country.sync_list(b1tdc, 'test', wanted)
+    assert b1tdc.calls == [ ('create', 'test', 1) ]
+
+
+def test_sync_sends_only_changes():
+    b1tdc = FakeB1TDC()
+    b1tdc.create_custom_list('test', items(('1.0.0.0/24', 'AA'),
+                                           ('2.0.0.0/24', 'AA'),
+                                           ('3.0.0.0/24', 'BB')))
+    b1tdc.calls = []
+    wanted = items(('1.0.0.0/24', 'AA'),
+                   # Changed description is removed and added again
+                   ('3.0.0.0/24', 'CC'),
+                   ('4.0.0.0/24', 'DD'))
+    assert b1country.sync_list(b1tdc, 'test', wanted)
+    assert b1tdc.calls == [ ('delete', [ '2.0.0.0/24', '3.0.0.0/24' ]),
+                            ('post', [ '3.0.0.0/24', '4.0.0.0/24' ]) ]
+    assert contents(b1tdc, 'test') == sorted((i['item'], i['description'])
+                                             for i in wanted)
+
+
+def test_sync_unchanged_makes_no_changes():
+    b1tdc = FakeB1TDC()
+    wanted = items(('1.0.0.0/24', 'AA'), ('2.0.0.0/24', 'BB'))
+    b1tdc.create_custom_list('test', wanted)
+    b1tdc.calls = []
+    assert b1country.sync_list(b1tdc, 'test', wanted)
+    assert b1tdc.calls == []
+
+
+def test_sync_with_index():
+    b1tdc = FakeB1TDC()
+    b1tdc.create_custom_list('test', items(('1.0.0.0/24', 'AA')))
+    b1tdc.calls = []
+    index = b1country.CustomListIndex(b1tdc)
+    assert b1country.sync_list(b1tdc, 'test', items(('2.0.0.0/24', 'AA')),
+                               index=index)
+    assert contents(b1tdc, 'test') == [ ('2.0.0.0/24', 'AA') ]
+
+
+def test_sync_failure_skips_add():
+    b1tdc = FakeB1TDC()
+    b1tdc.create_custom_list('test', items(('1.0.0.0/24', 'AA')))
+    b1tdc.calls = []
+    b1tdc.fail.add('delete')
+    errors = {}
+    assert not b1country.sync_list(b1tdc, 'test', items(('2.0.0.0/24', 'AA')),
+                                   errors=errors)
+    assert b1tdc.calls == []
+    assert 'test' in errors
+
+
+def nets(*counts):
+    return [ { 'item': f'{country}-{n}', 'description': country }
+             for country, count in counts for n in range(count) ]
+
+
+def test_plan_chunks_positional():
+    chunks = b1country.plan_chunks(nets(('AA', 20)), 'test', max_items=10)
+    assert [ (name, len(i)) for name, i in chunks ] == [ ('test-0', 10),
+                                                         ('test-1', 10) ]
+    chunks = b1country.plan_chunks(nets(('AA', 5)), 'test', max_items=10)
+    assert [ (name, len(i)) for name, i in chunks ] == [ ('test', 5) ]
+
+
+def test_plan_chunks_by_country():
+    planned = nets(('BB', 3), ('AA', 12), ('CC', 4), ('DD', 2), ('EE', 9))
+    chunks = b1country.plan_chunks(planned, 'test', max_items=10,
+                                   by_country=True)
+    assert [ (name, len(i)) for name, i in chunks ] == [
+        ('test-AA-0', 10), ('test-AA-CC', 9), ('test-DD', 2),
+        ('test-EE', 9) ]
+    # Countries are only split when larger than a list
+    for name, chunk in chunks[1:]:
+        for country in { i['description'] for i in chunk }:
+            assert country == 'AA' or all(i in chunk for i in planned
+                                          if i['description'] == country)
+
+
+def test_plan_chunks_per_country():
+    planned = nets(('BB', 3), ('AA', 12), ('CN/HK', 1))
+    chunks = b1country.plan_chunks(planned, 'test', max_items=10,
+                                   per_country=True)
+    assert [ (name, len(i)) for name, i in chunks ] == [
+        ('test-AA-0', 10), ('test-AA-1', 2), ('test-BB', 3),
+        ('test-XX', 1) ]
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+------------------------------------------------------------------------
+
+ Description:
+  Tests for address parsing, range flattening and country lookups,
+  checked against ip_to_int() and a brute force longest prefix match.
+
+ Usage:
+    python -m pytest tests
+
+------------------------------------------------------------------------
+"""
+import os
+import sys
+import random
+import ipaddress
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import b1td_country_ip_blocking as b1country
+
+
+needs_numpy = pytest.mark.skipif(not b1country.numpy,
+                                 reason='numpy not available')
+
+TRICKY_ADDRESSES = [
+    '1.2.3.4', '0.0.0.0', '255.255.255.255', '1.2.3.0', '1.2.3.255',
+    '01.2.3.4', '1.2.3.04', '00.0.0.0', '0.00.1.1', '1.2.3', '1.2.3.4.5',
+    '1.2.3.4.', '.1.2.3', '1..2.3', '.', '...', '', '256.1.1.1',
+    '1.2.3.256', '100.200.300.4', '1234.1.1.1', '9.9.9.999', '9' * 20,
+    '1.2.3.4 ', ' 1.2.3.4', '1.2.3.4\x00', '1.2.3.4\x00x',
+    '１.2.3.4', '1.2.3.4é', '\ud800.1.1.1', '10.0.0.1/8',
+    'a.b.c.d', '2001:db8::1', '::ffff:1.2.3.4', '::',
+]
+
+
+def reference_int(address):
+    '''
+    Parse with ip_to_int(), None for anything not a valid IPv4 address
+    '''
+    try:
+        version, value = b1country.ip_to_int(address)
+    except ValueError:
+        return None
+    return value if version == 4 else None
+
+
+def fuzzed_addresses(rng, count, inserts='0.9x :'):
+    '''
+    Valid IPv4 addresses with random insertions and deletions
+    '''
+    addresses = []
+    for _ in range(count):
+        address = str(ipaddress.IPv4Address(rng.getrandbits(32)))
+        choice = rng.random()
+        if choice < 0.3:
+            n = rng.randrange(len(address) + 1)
+            address = address[:n] + rng.choice(inserts) + address[n:]
+        elif choice < 0.5:
+            n = rng.randrange(len(address))
+            address = address[:n] + address[n + 1:]
+        addresses.append(address)
+    return addresses
+
+
+def random_subnets(rng, count, countries=('AA', 'BB', 'CC', 'DD')):
+    '''
+    Random, possibly nested, IPv4 subnets and one IPv6 subnet
+    '''
+    subnets = [ { 'cidr': '2001:db8::/32', 'country': 'ZZ' } ]
+    networks = set()
+    while len(networks) < count:
+        prefix = rng.randint(8, 28)
+        start = rng.getrandbits(32) >> (32 - prefix) << (32 - prefix)
+        networks.add(ipaddress.IPv4Network((start, prefix)))
+    # Each network once, so the most specific match is unambiguous
+    for network in sorted(networks):
+        subnets.append({ 'cidr': str(network),
+                         'country': rng.choice(countries) })
+    return subnets
+
+
+def brute_force_lookup(subnets, address):
+    '''
+    Country of the most specific subnet containing address
+    '''
+    address = ipaddress.ip_address(address)
+    best = None
+    for subnet in subnets:
+        network = ipaddress.ip_network(subnet['cidr'])
+        if address in network:
+            if best is None or network.prefixlen > best[0]:
+                best = (network.prefixlen, subnet['country'])
+    return best[1] if best else None
+
+
+@needs_numpy
+def test_ipv4_to_ints_tricky():
+    values, valid = b1country.ipv4_to_ints(TRICKY_ADDRESSES)
+    for address, value, ok in zip(TRICKY_ADDRESSES, values.tolist(),
+                                  valid.tolist()):
+        expected = reference_int(address)
+        assert ok == (expected is not None), repr(address)
+        if ok:
+            assert value == expected, repr(address)
+
+
+@needs_numpy
+def test_ipv4_to_ints_fuzzed():
+    rng = random.Random(1)
+    addresses = fuzzed_addresses(rng, 20000)
+    values, valid = b1country.ipv4_to_ints(addresses)
+    for address, value, ok in zip(addresses, values.tolist(),
+                                  valid.tolist()):
+        expected = reference_int(address)
+        assert ok == (expected is not None), repr(address)
+        if ok:
+            assert value == expected, repr(address)
+
+
+@needs_numpy
+def test_ipv4_to_ints_newline():
+    # A newline within an address leaves the whole batch to the caller
+    values, valid = b1country.ipv4_to_ints(['1.2.3.4', '1.2.3.4\n5'])
+    assert not valid.any()
+
+
+@needs_numpy
+def test_ipv4_to_ints_not_str():
+    # Batches with other types are left to the caller to parse
+    values, valid = b1country.ipv4_to_ints(['1.2.3.4', None, b'1.2.3.4'])
+    assert not valid.any()
+    values, valid = b1country.ipv4_to_ints([])
+    assert len(values) == len(valid) == 0
+
+
+def test_flatten_ranges_brute_force():
+    rng = random.Random(2)
+    for _ in range(50):
+        # Nested and disjoint CIDR style ranges over a small space
+        ranges = set()
+        for _ in range(rng.randint(1, 20)):
+            size = 2 ** rng.randint(0, 6)
+            start = rng.randrange(0, 256, size)
+            ranges.add((start, start + size - 1))
+        ranges = [ (start, end, rng.choice('ABC'))
+                   for start, end in sorted(ranges) ]
+        flat = b1country.flatten_ranges(list(ranges))
+
+        for previous, current in zip(flat, flat[1:]):
+            assert previous[1] < current[0]
+            # Adjacent ranges with the same label are joined
+            assert not (previous[1] + 1 == current[0] and
+                        previous[2] == current[2])
+        for address in range(256):
+            containing = [ r for r in ranges if r[0] <= address <= r[1] ]
+            expected = (min(containing, key=lambda r: r[1] - r[0])[2]
+                        if containing else None)
+            found = [ r[2] for r in flat if r[0] <= address <= r[1] ]
+            assert found == ([ expected ] if expected else [])
+
+
+@pytest.mark.parametrize('engine', [
+    'python', pytest.param('numpy', marks=needs_numpy) ])
+def test_lookup_brute_force(engine):
+    rng = random.Random(3)
+    subnets = random_subnets(rng, 300)
+    index = b1country.CountryLookup(subnets, engine=engine)
+    addresses = [ str(ipaddress.IPv4Address(rng.getrandbits(32)))
+                  for _ in range(500) ]
+    # First and last address of every subnet, and either side
+    for subnet in subnets[1:]:
+        network = ipaddress.IPv4Network(subnet['cidr'])
+        first = int(network.network_address)
+        last = int(network.broadcast_address)
+        addresses += [ str(ipaddress.IPv4Address(n))
+                       for n in (first - 1, first, last, last + 1)
+                       if 0 <= n < 2 ** 32 ]
+    addresses += [ '2001:db8::1', '2001:db9::1' ]
+
+    expected = [ brute_force_lookup(subnets, a) for a in addresses ]
+    assert [ index.lookup(a) for a in addresses ] == expected
+    assert index.lookup_many(addresses) == expected
+
+
+@pytest.mark.parametrize('engine', [
+    'python', pytest.param('numpy', marks=needs_numpy) ])
+def test_lookup_many_matches_lookup(engine):
+    rng = random.Random(4)
+    index = b1country.CountryLookup(random_subnets(rng, 2000),
+                                    engine=engine)
+    addresses = (TRICKY_ADDRESSES + fuzzed_addresses(rng, 5000) +
+                 [ '1.2.3.4\n5', None, 5, b'1.2.3.4' ])
+    expected = []
+    for address in addresses:
+        try:
+            expected.append(index.lookup(address))
+        except ValueError:
+            expected.append(None)
+    assert index.lookup_many(addresses) == expected
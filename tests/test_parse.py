@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+"""
+------------------------------------------------------------------------
+
+ Description:
+  Tests for the incremental country_ip parser, checked against
+  json.loads() with the body split at every chunk boundary.
+
+ Usage:
+    python -m pytest tests
+
+------------------------------------------------------------------------
+"""
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+import b1td_country_ip_blocking as b1country
+
+
+RECORDS = [
+    { 'cidr': '1.2.3.0/24', 'country': 'AA' },
+    { 'cidr': '2001:db8::/32', 'country': 'BB' },
+    # Multibyte UTF-8 and escapes split across chunks
+    { 'cidr': '10.0.0.0/8', 'country': 'CC', 'name': 'Côte d’Ivoire' },
+    { 'cidr': '192.0.2.0/24', 'country': 'DD', 'note': 'a "quoted" ]' },
+]
+
+
+def bodies():
+    '''
+    Encodings of the same response, compact, indented and with other
+    members around the array
+    '''
+    return [
+        json.dumps({ 'country_ip': RECORDS }).encode(),
+        json.dumps({ 'country_ip': RECORDS }, indent=2,
+                   ensure_ascii=False).encode(),
+        json.dumps({ 'count': 4, 'country_ip': RECORDS,
+                     'next': '"country_ip": [' }).encode(),
+    ]
+
+
+def chunked(body, size):
+    return [ body[n:n + size] for n in range(0, len(body), size) ]
+
+
+@pytest.mark.parametrize('body', bodies())
+def test_every_split(body):
+    for split in range(len(body) + 1):
+        chunks = [ body[:split], body[split:] ]
+        assert list(b1country.iter_country_ips(chunks)) == RECORDS
+
+
+@pytest.mark.parametrize('body', bodies())
+@pytest.mark.parametrize('size', [ 1, 2, 3, 5, 7, 16, 64 ])
+def test_chunk_sizes(body, size):
+    records = list(b1country.iter_country_ips(chunked(body, size)))
+    assert records == json.loads(body)['country_ip']
+
+
+def test_empty_array():
+    body = json.dumps({ 'country_ip': [] }).encode()
+    assert list(b1country.iter_country_ips(chunked(body, 3))) == []
+
+
+def test_missing_key():
+    body = json.dumps({ 'error': 'not found' }).encode()
+    assert list(b1country.iter_country_ips(chunked(body, 3))) == []
+
+
+def test_truncated():
+    body = bodies()[0]
+    start = body.index(b'[') + 1
+    end = body.rindex(b']')
+    for length in range(start, end):
+        with pytest.raises(ValueError):
+            list(b1country.iter_country_ips([ body[:length] ]))
+
+
+def test_drains_chunks():
+    # Pass through consumers such as the cache must see the whole body
+    body = bodies()[2]
+    seen = []
+
+    def chunks():
+        for chunk in chunked(body, 4):
+            seen.append(chunk)
+            yield chunk
+
+    assert list(b1country.iter_country_ips(chunks())) == RECORDS
+    assert b''.join(seen) == body